@@ -0,0 +1,60 @@
+import argparse
+import os
+import subprocess
+import sys
+
+LAZY_MODULES = [
+    'thomas',
+    'streaming.torrentfile',
+    'twisted.web.client',
+    'twisted.web.server',
+    'twisted.web.static',
+]
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import streaming.core
+print(time.time() - start)
+print(','.join(m for m in %r if m in sys.modules))
+"""
+
+
+def measure_import(plugin_path):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([plugin_path, env.get('PYTHONPATH', '')])
+
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % (LAZY_MODULES, )], env=env)
+    lines = output.decode('utf-8').splitlines()
+    import_time, loaded_modules = lines[-2], lines[-1]
+    return float(import_time), [m for m in loaded_modules.split(',') if m]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how long it takes to import the streaming plugin.')
+    parser.add_argument('--plugin-path', type=str, help='Folder containing the streaming package',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    parser.add_argument('--runs', '-n', type=int, default=5, help='Number of imports to time')
+    parser.add_argument('--max-ms', type=float, default=0, help='Fail if the median import time is above this')
+
+    args = parser.parse_args()
+
+    import_times = []
+    for _ in range(args.runs):
+        import_time, loaded_modules = measure_import(args.plugin_path)
+        import_times.append(import_time * 1000)
+
+    import_times.sort()
+    median = import_times[len(import_times) // 2]
+    print('Import time: median %.1fms min %.1fms max %.1fms' % (median, import_times[0], import_times[-1]))
+
+    failed = False
+    if loaded_modules:
+        print('Modules that should only be imported on first use were imported: %s' % (', '.join(loaded_modules), ))
+        failed = True
+
+    if args.max_ms and median > args.max_ms:
+        print('Import time is above %.1fms' % (args.max_ms, ))
+        failed = True
+
+    sys.exit(failed and 1 or 0)
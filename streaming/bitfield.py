@@ -0,0 +1,65 @@
+UNSET = b'\x00'
+SET = b'\x01'
+
+
+class Bitfield(object):
+    """
+    Piece states kept in a bytearray, byte n is 1 when piece n is set.
+
+    Lookups are O(1) and searching and counting are done by bytearray.find
+    and bytearray.count instead of walking a list with one object per piece.
+    """
+    def __init__(self, bits=None):
+        self.bits = bits if bits is not None else bytearray()
+
+    @classmethod
+    def from_bools(cls, bools):
+        return cls(bytearray(1 if b else 0 for b in bools))
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, index):
+        try:
+            return self.bits[index] == 1
+        except IndexError:
+            raise IndexError('bitfield index out of range')
+
+    def find(self, value, start, end):
+        if end is None:
+            end = len(self.bits)
+        if start >= end:
+            return None
+
+        index = self.bits.find(value, start, end)
+        if index == -1:
+            return None
+        return index
+
+    def first_unset(self, start=0, end=None):
+        """
+        Index of the first unset bit in [start, end) or None.
+        """
+        return self.find(UNSET, start, end)
+
+    def first_set(self, start=0, end=None):
+        return self.find(SET, start, end)
+
+    def iter_unset(self, start=0, end=None):
+        if end is None:
+            end = len(self.bits)
+
+        index = self.first_unset(start, end)
+        while index is not None:
+            yield index
+            index = self.first_unset(index + 1, end)
+
+    def count_set(self, start=0, end=None):
+        if end is None:
+            end = len(self.bits)
+        if start >= end:
+            return 0
+        return self.bits.count(SET, start, end)
+
+    def all_set(self, start=0, end=None):
+        return self.first_unset(start, end) is None
@@ -0,0 +1,146 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+BEHIND_PLAYHEAD_PENALTY = 1000000
+
+
+def get_playhead(holder):
+    try:
+        return holder.current_piece[0]
+    except TypeError:  # reader has not seeked yet, or a holder that is not a reader
+        return None
+
+
+class BufferPool(object):
+    """
+    Process-wide byte budget for the pieces buffered by streaming readers.
+
+    When the budget is exceeded the pieces furthest from any reader's playhead
+    on the same torrent are dropped first, pieces behind every playhead before
+    anything else. The piece a reader is currently on is never dropped.
+
+    Readers of the same torrent get the same data for a piece, it is only counted once
+    and only freed when every holder of the piece has dropped it. Holders other than
+    readers, like the piece fanout, have no playhead.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.references = {}
+        self.used_bytes = 0
+        self.evictions = 0
+
+    def get_reader_budget(self, piece_length):
+        """
+        How many pieces a single reader may keep buffered, None means unlimited.
+        """
+        if not self.max_bytes:
+            return None
+
+        with self.lock:
+            readers = len(set(reader for reader, _ in self.buffers if get_playhead(reader) is not None)) or 1
+
+        return max(2, self.max_bytes // (readers * piece_length))
+
+    def add(self, reader, piece, size):
+        with self.lock:
+            self._remove(reader, piece)
+            self.buffers[(reader, piece)] = size
+            shared_key = (reader.infohash, piece)
+            references = self.references.get(shared_key, 0)
+            if not references:
+                self.used_bytes += size
+            self.references[shared_key] = references + 1
+
+            if self.max_bytes and self.used_bytes > self.max_bytes:
+                evicted = self._evict()
+            else:
+                evicted = []
+
+        for reader, piece in evicted:
+            reader.evict_piece(piece)
+
+    def _remove(self, reader, piece):
+        size = self.buffers.pop((reader, piece), None)
+        if size is None:
+            return
+
+        shared_key = (reader.infohash, piece)
+        references = self.references.pop(shared_key) - 1
+        if references:
+            self.references[shared_key] = references
+        else:
+            self.used_bytes -= size
+
+    def remove(self, reader, piece):
+        with self.lock:
+            self._remove(reader, piece)
+
+    def remove_reader(self, reader):
+        with self.lock:
+            for key in [key for key in self.buffers if key[0] is reader]:
+                self._remove(*key)
+
+    def _get_playheads(self):
+        playheads = {}
+        for reader, _ in self.buffers:
+            playhead = get_playhead(reader)
+            if playhead is not None:
+                playheads.setdefault(reader.infohash, set()).add(playhead)
+        return playheads
+
+    def _get_distance(self, playheads, infohash, piece):
+        distances = []
+        for playhead in playheads.get(infohash, []):
+            if piece >= playhead:
+                distances.append(piece - playhead)
+            else:
+                distances.append(BEHIND_PLAYHEAD_PENALTY + playhead - piece)
+        return min(distances or [BEHIND_PLAYHEAD_PENALTY * 2])
+
+    def _evict(self):
+        """
+        Drops pieces with all their holders, dropping a piece for only some of them frees nothing.
+        """
+        playheads = self._get_playheads()
+        holders = {}
+        for reader, piece in self.buffers:
+            holders.setdefault((reader.infohash, piece), []).append((reader, piece))
+
+        protected = set()
+        for reader, _ in self.buffers:
+            playhead = get_playhead(reader)
+            if playhead is not None:
+                protected.add((reader.infohash, playhead))
+
+        candidates = sorted(
+            (shared_key for shared_key in holders if shared_key not in protected),
+            key=lambda shared_key: self._get_distance(playheads, *shared_key),
+            reverse=True)
+
+        evicted = []
+        for shared_key in candidates:
+            if self.used_bytes <= self.max_bytes:
+                break
+            for key in holders[shared_key]:
+                self._remove(*key)
+                evicted.append(key)
+
+        if evicted:
+            self.evictions += len(evicted)
+            logger.debug('Evicted %s buffered pieces, %s bytes in use' % (len(evicted), self.used_bytes))
+
+        return evicted
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'used_bytes': self.used_bytes,
+                'pieces': len(self.buffers),
+                'readers': len(set(reader for reader, _ in self.buffers if get_playhead(reader) is not None)),
+                'evictions': self.evictions,
+            }
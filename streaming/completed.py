@@ -0,0 +1,107 @@
+import base64
+import mimetypes
+import os
+
+try:
+    from urllib.parse import quote, urlencode
+except ImportError:
+    from urllib import quote, urlencode
+
+from twisted.web.resource import Resource as TwistedResource, ForbiddenResource, NoResource
+
+from .resource import get_client_ip
+from .signing import to_bytes
+
+
+def encode_path(path):
+    return base64.urlsafe_b64encode(to_bytes(path)).rstrip(b'=').decode('ascii')
+
+
+def decode_path(token):
+    token = to_bytes(token)
+    return base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4)).decode('utf-8')
+
+
+def create_completed_url(signer, path, client_ip=None):
+    """
+    Returns a signed url path serving a completely downloaded file straight from disk.
+    The signature is always required as the token contains the path of the file.
+    """
+    token = encode_path(path)
+    filename = quote(os.path.basename(path).encode('utf-8'))
+    return '/completed/%s/%s?%s' % (token, filename, urlencode(signer.sign(token, client_ip)))
+
+
+class CompletedFileResource(TwistedResource):
+    """
+    Serves files created with create_completed_url, the last part of the url is only there
+    to give players a filename.
+    """
+    isLeaf = True
+
+    def __init__(self, signer, trust_forwarded_for=False):
+        self.signer = signer
+        self.trust_forwarded_for = trust_forwarded_for
+        TwistedResource.__init__(self)
+
+    def get_path(self, request):
+        if not request.postpath or not request.postpath[0]:
+            return None
+
+        token = request.postpath[0].decode('ascii', 'replace')
+        client_ip = get_client_ip(request, self.trust_forwarded_for)
+        if not self.signer.verify(token, request.args, client_ip):
+            return None
+
+        try:
+            return decode_path(token)
+        except ValueError:
+            return None
+
+    def render(self, request):
+        path = self.get_path(request)
+        if path is None:
+            return ForbiddenResource('Invalid or expired signature').render(request)
+
+        if not os.path.isfile(path):
+            return NoResource().render(request)
+
+        return self.serve_file(request, path)
+
+    def serve_file(self, request, path):
+        from twisted.web import static
+
+        return static.File(path).render(request)
+
+
+class OffloadFileResource(CompletedFileResource):
+    """
+    Lets a reverse proxy send the file, only the authorization is done here.
+
+    With x-accel-redirect (nginx) the path below root is appended to location, which must be an
+    internal location mapped to root. With x-sendfile (lighttpd, apache) the full path is sent.
+    """
+    def __init__(self, signer, trust_forwarded_for=False, offload='x-accel-redirect', location='', root=''):
+        self.offload = offload
+        self.location = location
+        self.root = root
+        CompletedFileResource.__init__(self, signer, trust_forwarded_for)
+
+    def serve_file(self, request, path):
+        # nginx passes the content type of this response on with the file
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        request.setHeader(b'Content-Type', to_bytes(content_type))
+
+        if self.offload == 'x-sendfile':
+            request.setHeader(b'X-Sendfile', to_bytes(path))
+            return b''
+
+        relative_path = path
+        if self.root:
+            relative_path = os.path.relpath(path, self.root)
+            if relative_path == '..' or relative_path.startswith('..' + os.sep):
+                return ForbiddenResource('File is outside of the offload root').render(request)
+
+        redirect = '%s/%s' % (self.location.rstrip('/'), quote(to_bytes(relative_path.lstrip('/'))))
+        request.setHeader(b'X-Accel-Redirect', to_bytes(redirect))
+        return b''
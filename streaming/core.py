@@ -38,34 +38,49 @@
 #
 
 import base64
+import binascii
+import hashlib
 import json
 import logging
 import os
 import random
+import socket
+import stat
 import string
+import threading
 import time
 
 import deluge.configmanager
 
+try:
+    from urllib.parse import parse_qs, urlencode
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qs
+
 from copy import copy
 from datetime import datetime, timedelta
 from types import MethodType
 
 from deluge import component, configmanager
-from deluge._libtorrent import lt
 from deluge.core.rpcserver import export
 from deluge.plugins.pluginbase import CorePluginBase
 
-from twisted.internet import reactor, defer, task, error
-from twisted.web import server, client
+from twisted.internet import reactor, defer, task, error, threads
 from twisted.web.resource import Resource as TwistedResource
 
-from thomas import router, Item, OutputBase
-
-from .resource import Resource
-from .torrentfile import DelugeTorrentInput
-
-router.register_handler(DelugeTorrentInput.plugin_name, DelugeTorrentInput, True, False, False)
+from .bitfield import Bitfield
+from .bufferpool import BufferPool
+from .completed import OffloadFileResource, create_completed_url
+from .fanout import PieceFanout, get_attached_readers, get_playheads
+from .fetcher import FetchError, TorrentFetcher
+from .rarindex import HEADER_READ_SIZE, RarIndex, RarIndexCache, RarIndexError, is_rar_volume, read_volume
+from .resource import Resource, SignedResource, get_client_ip
+from .scheduler import StreamScheduler
+from .signing import UrlSigner
+from .singleflight import SingleFlight
+from .stall import StallController
+from .state import load_state, save_state
 
 VIDEO_STREAMABLE_EXTENSIONS = ['mkv', 'mp4', 'iso', 'ogg', 'ogm', 'm4v']
 AUDIO_STREAMABLE_EXTENSIONS = ['flac', 'mp3', 'oga']
@@ -77,6 +92,33 @@ MIN_WAIT_PIECE_PRIORITY_DELAY = timedelta(seconds=5)
 WITHIN_CHAIN_PERCENTAGE = 0.10
 MIN_PIECE_COUNT_FOR_CHAIN_CONSIDERATION = 40
 MIN_CHAIN_WAIT_DELAY = timedelta(seconds=8)
+STREAM_RESULT_MEMO_TIME = 10
+FILE_HEAD_PIECE_COUNT = 4
+PREFETCH_IDLE_TIMEOUT = timedelta(minutes=10)
+PREFETCH_PIECE_PRIORITY = 3
+PREFETCH_TAIL_SIZE = 2 * 1024 * 1024
+PREFETCH_UPGRADE_DEADLINE_SPACING = 100
+PROXY_OFFLOAD_METHODS = ['x-accel-redirect', 'x-sendfile']
+LOOKAHEAD_INTERVAL = 1
+READER_REAP_INTERVAL = 10
+STALL_CHECK_INTERVAL = 1
+DOWNLOAD_QUEUE_SNAPSHOT_TIME = 1
+STATUS_SNAPSHOT_TIME = 0.2
+PERMANENT_STATUS_KEYS = set(['files', 'piece_length'])
+LOOKAHEAD_DEADLINE_SPACING = 500
+RAR_NEXT_VOLUME_PREFETCH_DISTANCE = 16 * 1024 * 1024
+RAR_NEXT_VOLUME_HEAD_SIZE = 2 * 1024 * 1024
+SCHEDULER_DEADLINE_PIECES = 4
+LISTENER_CONFIG_KEYS = set(['ip', 'port', 'serve_method', 'use_ssl', 'ssl_source', 'ssl_priv_key_path', 'ssl_cert_path',
+                            'unix_socket_path', 'unix_socket_mode'])
+UNIX_SOCKET_FILENAME = 'streaming.sock'
+WORKER_CONFIG_KEYS = set(['worker_processes', 'worker_port', 'signed_url_secret', 'signed_url_bind_ip', 'reverse_proxy_enabled'])
+SIGNING_CONFIG_KEYS = set(['sign_stream_urls', 'signed_url_secret', 'signed_url_lifetime', 'signed_url_bind_ip'])
+STATE_FILENAME = 'streaming_state.json'
+STATE_SAVE_INTERVAL = 30
+STATE_MAX_AGE = 60 * 60
+STATE_RESTORE_TIMEOUT = 10 * 60
+RESUME_PREFETCH_SIZE = 16 * 1024 * 1024
 
 
 DEFAULT_PREFS = {
@@ -96,11 +138,123 @@ DEFAULT_PREFS = {
     'ssl_priv_key_path': '',
     'ssl_cert_path': '',
     'aggressive_prioritizing': False,
+    'sign_stream_urls': False,
+    'signed_url_secret': ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(32)),
+    'signed_url_lifetime': 24 * 60 * 60,
+    'signed_url_bind_ip': False,
+    'torrent_cache_max_entries': 100,
+    'torrent_cache_max_bytes': 50 * 1024 * 1024,
+    'torrent_cache_max_age': 60 * 60,
+    'torrent_fetch_timeout': 30,
+    'http_api_fetch_urls': False,
+    'magnet_metadata_timeout': 60,
+    'prefetch_default_size': 32 * 1024 * 1024,
+    'prefetch_bitrate': 1024 * 1024,
+    'use_scheduler': False,
+    'scheduler_capacity': 0,
+    'admission_control': False,
+    'admission_default_bitrate': 1024 * 1024,
+    'admission_min_headroom': 0.1,
+    'admission_retry_after': 30,
+    'admission_queue_timeout': 0,
+    'buffer_memory_limit': 256 * 1024 * 1024,
+    'persist_state': True,
+    'worker_processes': 0,
+    'worker_port': 46124,
+    'worker_base_url': '',
+    'proxy_offload': '',
+    'proxy_offload_location': '/streaming-internal',
+    'proxy_offload_root': '',
+    'unix_socket_path': '',
+    'unix_socket_mode': 0o660,
+    'lookahead_bytes': 32 * 1024 * 1024,
+    'lookahead_seconds': 60,
+    'fanout_window': 64 * 1024 * 1024,
+    'read_stall_timeout': 300,
+    'stall_tuning': True,
+    'stall_threshold': 5,
+    'stall_max_connections': 500,
+    'stall_upload_slots': 1,
 }
 
 logger = logging.getLogger(__name__)
 
 
+class StreamError(Exception):
+    pass
+
+
+def is_magnet(uri):
+    return uri.lower().startswith('magnet:')
+
+
+def get_magnet_infohash(uri):
+    """
+    Returns the hex encoded infohash found in a magnet uri or None.
+    """
+    if '?' not in uri:
+        return None
+
+    for xt in parse_qs(uri.split('?', 1)[1]).get('xt', []):
+        if not xt.lower().startswith('urn:btih:'):
+            continue
+
+        infohash = xt[9:]
+        if len(infohash) == 40:
+            return infohash.lower()
+        elif len(infohash) == 32:
+            try:
+                return binascii.hexlify(base64.b32decode(infohash.upper())).decode('ascii')
+            except (TypeError, ValueError):
+                return None
+
+    return None
+
+
+def parse_torrent(filedump):
+    """
+    Raises ValueError for anything that is not a valid torrent.
+    """
+    from deluge._libtorrent import lt
+    try:
+        metainfo = lt.bdecode(filedump)
+        if metainfo is None:
+            raise ValueError('not bencoded')
+        return lt.torrent_info(metainfo)
+    except (RuntimeError, TypeError) as e:  # boost ArgumentError is a TypeError
+        raise ValueError(str(e))
+
+
+thomas_handlers_registered = False
+
+
+def register_thomas_handlers():
+    """
+    thomas is imported and told about torrent inputs the first time something is streamed,
+    not when the plugin is loaded.
+    """
+    global thomas_handlers_registered
+    if thomas_handlers_registered:
+        return
+
+    from thomas import router
+    from .torrentfile import DelugeTorrentInput
+
+    router.register_handler(DelugeTorrentInput.plugin_name, DelugeTorrentInput, True, False, False)
+    thomas_handlers_registered = True
+
+
+def remove_stale_socket(path):
+    """
+    A socket file left behind by a daemon that did not shut down cleanly blocks listening.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except OSError:
+        pass
+
+
 def sleep(secs):
     d = defer.Deferred()
     reactor.callLater(secs, d.callback, None)
@@ -135,22 +289,71 @@ class Torrent(object):
 
         self.filesets = {}
         self.readers = {}
+        self.prefetches = {}
+        self.rar_indexes = {}
+        self.prefetched_volumes = set()
+        self.updating_rar_indexes = False
+        self.download_queue_lock = threading.Lock()
+        self.download_queue_snapshot = None
+        self.download_queue_updated = 0
+        self.weight = 1
+        self.allocated_rate = 0
         self.cycle_lock = defer.DeferredLock()
         self.last_activity = datetime.now()
         self.waited_pieces = set()
 
+        self.status_lock = threading.Lock()
+        self.status_snapshot = {}
+        self.has_metadata = False
+        self.fanout = PieceFanout(infohash, torrent_handler.buffer_pool)
+        self.stall_controller = StallController(self)
+
         self.torrent = get_torrent(infohash)
-        status = self.torrent.get_status(['piece_length'])
-        self.piece_length = status['piece_length']
         self.torrent.handle.set_sequential_download(True)
         self.torrent.handle.set_priority(1)
 
+    @property
+    def piece_length(self):
+        return self.get_status(['piece_length'])['piece_length']
+
+    def get_status(self, keys):
+        """
+        Status fields from a snapshot shared by all readers, each field is fetched at most
+        once per STATUS_SNAPSHOT_TIME and fields that never change are only fetched once
+        when the torrent has metadata. The returned values are shared and must not be changed.
+        """
+        with self.status_lock:
+            if not self.has_metadata and self.torrent.handle.has_metadata():
+                self.has_metadata = True
+                for key in PERMANENT_STATUS_KEYS:  # fetched before the metadata arrived
+                    self.status_snapshot.pop(key, None)
+            permanent_keys = self.has_metadata and PERMANENT_STATUS_KEYS or set()
+
+            now = time.time()
+            missing = [key for key in keys if key not in self.status_snapshot or
+                       (key not in permanent_keys and self.status_snapshot[key][0] + STATUS_SNAPSHOT_TIME < now)]
+
+            deluge_keys = [key for key in missing if key != 'pieces']
+            if deluge_keys:
+                for key, value in self.torrent.get_status(deluge_keys).items():
+                    self.status_snapshot[key] = (now, value)
+
+            if 'pieces' in missing:  # deluge builds its own piece states from the peer list, that is not needed here
+                self.status_snapshot['pieces'] = (now, Bitfield.from_bools(self.torrent.handle.status().pieces))
+
+            return dict((key, self.status_snapshot[key][1]) for key in keys)
+
+    def invalidate_status(self, key):
+        with self.status_lock:
+            self.status_snapshot.pop(key, None)
+
     def ensure_started(self):
-        if self.torrent.status.paused:
+        # get_status also refreshes torrent.status, Deluge 1.3 reads it when resuming
+        if self.torrent.get_status(['paused'])['paused']:
             self.torrent.resume()
 
     def get_file_from_offset(self, offset):
-        status = self.torrent.get_status(['files'])
+        status = self.get_status(['files'])
         last_file = None
         for f in status['files']:
             if f['offset'] > offset:
@@ -159,16 +362,21 @@ class Torrent(object):
             last_file = f
         return last_file
 
-    def can_read(self, from_byte):
+    def can_read(self, from_byte, cancelled=None, deadline=None):
+        """
+        Waits until from_byte can be read, returns None if cancelled is set or the deadline passes first.
+        """
         self.ensure_started()
 
-        status = self.torrent.get_status(['pieces'])
+        pieces = self.get_status(['pieces'])['pieces']
         needed_piece, rest = divmod(from_byte, self.piece_length)
-        last_available_piece = None
-        for piece, status in enumerate(self.torrent.status.pieces[needed_piece:], needed_piece):
-            if not status:
-                break
-            last_available_piece = piece
+        first_missing_piece = pieces.first_unset(needed_piece)
+        if first_missing_piece is None:
+            last_available_piece = len(pieces) - 1
+        elif first_missing_piece > needed_piece:
+            last_available_piece = first_missing_piece - 1
+        else:
+            last_available_piece = None
 
         if last_available_piece is None:
             logger.debug('Since we are waiting for a piece, we need to check if we should set piece %s to max' % (needed_piece, ))
@@ -183,10 +391,11 @@ class Torrent(object):
                 best_reader_from_byte = max(reader[1] for reader in self.readers.values() if reader[1] <= from_byte)
                 best_reader_piece = best_reader_from_byte // self.piece_length
                 downloading_pieces = self.get_currently_downloading()
-                # TODO: unfinished_piece can be None
-                for unfinished_piece, status in enumerate(self.torrent.status.pieces[best_reader_piece:], best_reader_piece):
-                    if not status and unfinished_piece not in downloading_pieces:
-                        break
+                unfinished_piece = pieces.first_unset(best_reader_piece)
+                while unfinished_piece is not None and unfinished_piece in downloading_pieces:
+                    unfinished_piece = pieces.first_unset(unfinished_piece + 1)
+                if unfinished_piece is None:
+                    unfinished_piece = len(pieces) - 1
 
                 piece_diff = best_reader_piece - unfinished_piece - 1
                 if unfinished_piece >= best_reader_piece or piece_diff / file_piece_count <= WITHIN_CHAIN_PERCENTAGE:
@@ -206,7 +415,7 @@ class Torrent(object):
                 self.torrent.set_file_priorities(file_priorities)
 
             for i in range(300):
-                if self.torrent.status.pieces[needed_piece]:
+                if pieces[needed_piece]:
                     break
 
                 if not reactor.running:
@@ -217,28 +426,128 @@ class Torrent(object):
                     self.torrent.handle.set_piece_deadline(needed_piece, 0)
                     self.torrent.handle.piece_priority(needed_piece, MAX_PIECE_PRIORITY)
 
-                time.sleep(0.2)
-                status = self.torrent.get_status(['pieces'])
+                if deadline is not None and time.time() > deadline:
+                    logger.debug('Gave up waiting for piece %s' % (needed_piece, ))
+                    return
+
+                if cancelled is None:
+                    time.sleep(0.2)
+                elif cancelled.wait(0.2):
+                    return
+
+                pieces = self.get_status(['pieces'])['pieces']
 
             logger.debug('Calling read again to get the real number')
-            return self.can_read(from_byte)
+            return self.can_read(from_byte, cancelled, deadline)
         else:
             logger.debug('Really last available piece is %s' % (last_available_piece, ))
             return ((last_available_piece - needed_piece) * self.piece_length) + self.piece_length - rest, last_available_piece
 
     def is_idle(self):
-        return not self.readers and self.last_activity + TORRENT_CLEANUP_INTERVAL < datetime.now()
+        return not self.readers and not self.prefetches and self.last_activity + TORRENT_CLEANUP_INTERVAL < datetime.now()
 
     def add_reader(self, filelike, path, from_byte, to_byte):
         logger.debug('Added reader %s path:%s from_byte:%s' % (filelike, path, from_byte, ))
         self.readers[filelike] = (path, from_byte, to_byte)
 
+        if path in self.prefetches:
+            reactor.callFromThread(self.upgrade_prefetch, path)
+
         self.cycle()
 
+    def get_file_from_path(self, path):
+        status = self.get_status(['files'])
+        for f in status['files']:
+            if f['path'] == path:
+                return f
+        return None
+
+    def get_prefetch_pieces(self, prefetch):
+        pieces = set(range(prefetch['from_byte'] // self.piece_length,
+                           (prefetch['to_byte'] - 1) // self.piece_length + 1))
+        pieces.update(range(prefetch['tail_byte'] // self.piece_length,
+                            (prefetch['end_byte'] - 1) // self.piece_length + 1))
+        return sorted(pieces)
+
+    def add_prefetch(self, path, size):
+        """
+        Download the head of a file (and the tail where container indexes usually live)
+        with a low priority, like a reader that has not arrived yet.
+        """
+        f = self.get_file_from_path(path)
+        if f is None:
+            return None
+
+        size = min(size, f['size'])
+        if f['path'] in [reader[0] for reader in self.readers.values()]:
+            logger.debug('Path %s is already being read, no need to prefetch' % (path, ))
+            return size
+
+        self.ensure_started()
+        self.prefetches[path] = {
+            'from_byte': f['offset'],
+            'to_byte': f['offset'] + max(size, 1),
+            'tail_byte': max(f['offset'], f['offset'] + f['size'] - PREFETCH_TAIL_SIZE),
+            'end_byte': f['offset'] + max(f['size'], 1),
+            'expires': datetime.now() + PREFETCH_IDLE_TIMEOUT,
+        }
+        logger.debug('Prefetching %s bytes of %s' % (size, path))
+
+        file_priorities = list(self.torrent.get_file_priorities())
+        if file_priorities[f['index']] == 0:
+            file_priorities[f['index']] = 1
+            self.torrent.set_file_priorities(file_priorities)
+
+        self.apply_prefetches()
+        return size
+
+    def apply_prefetches(self):
+        pieces = self.get_status(['pieces'])['pieces']
+        for prefetch in self.prefetches.values():
+            for piece in self.get_prefetch_pieces(prefetch):
+                if pieces[piece]:
+                    continue
+
+                if self.torrent.handle.piece_priority(piece) < PREFETCH_PIECE_PRIORITY:
+                    self.torrent.handle.piece_priority(piece, PREFETCH_PIECE_PRIORITY)
+
+    def upgrade_prefetch(self, path):
+        """
+        A real reader arrived for a prefetched file, the pieces are now needed for playback.
+        """
+        prefetch = self.prefetches.pop(path, None)
+        if prefetch is None:
+            return
+
+        logger.debug('Upgrading prefetch of %s to a real stream' % (path, ))
+        pieces = self.get_status(['pieces'])['pieces']
+        for i, piece in enumerate(self.get_prefetch_pieces(prefetch)):
+            if pieces[piece]:
+                continue
+
+            self.torrent.handle.set_piece_deadline(piece, i * PREFETCH_UPGRADE_DEADLINE_SPACING)
+            self.torrent.handle.piece_priority(piece, MAX_PIECE_PRIORITY)
+
+    def expire_prefetches(self):
+        now = datetime.now()
+        expired = [path for path, prefetch in self.prefetches.items() if prefetch['expires'] < now]
+        if not expired:
+            return
+
+        pieces = self.get_status(['pieces'])['pieces']
+        for path in expired:
+            logger.debug('Prefetch of %s expired' % (path, ))
+            prefetch = self.prefetches.pop(path)
+            for piece in self.get_prefetch_pieces(prefetch):
+                if not pieces[piece] and self.torrent.handle.piece_priority(piece) == PREFETCH_PIECE_PRIORITY:
+                    self.torrent.handle.piece_priority(piece, 1)
+            self.last_activity = datetime.now()
+
     def remove_reader(self, filelike):
         if filelike in self.readers:
             logger.debug('Removed reader %s' % (filelike, ))
             del self.readers[filelike]
+            self.fanout.trim(get_playheads(list(self.readers.keys())), self.get_fanout_window())
             self.cycle()
             self.last_activity = datetime.now()
 
@@ -268,12 +577,13 @@ class Torrent(object):
                 fileset['started'] = True
             cannot_blacklist |= set(fileset['files'])
             first_files.add(fileset['files'][0])
+        cannot_blacklist |= set(self.prefetches.keys())
 
         if found_not_started:
             self.ensure_started()
 
             logger.debug('We had a fileset not started, must_whitelist:%r first_files:%r cannot_blacklist:%r' % (must_whitelist, first_files, cannot_blacklist))
-            status = self.torrent.get_status(['files', 'file_progress'])
+            status = self.get_status(['files', 'file_progress'])
 
             file_priorities = list(self.torrent.get_file_priorities())
             for f, progress in zip(status['files'], status['file_progress']):
@@ -293,7 +603,7 @@ class Torrent(object):
             self.torrent.set_file_priorities(file_priorities)
 
         if self.readers:
-            status = self.torrent.get_status(['files', 'file_progress', 'pieces'])
+            status = self.get_status(['files', 'file_progress', 'pieces'])
             file_ranges = {}
             fileset_ranges = {}
             for path, from_byte, to_byte in self.readers.values():
@@ -345,8 +655,8 @@ class Torrent(object):
                 last_piece = (f['offset'] + f['size']) // self.piece_length
                 logger.debug('Configuring pieces first piece %s current piece %s - all before should be blacklisted' % (first_piece, current_piece))
 
-                for piece, piece_status in enumerate(self.torrent.status.pieces[first_piece:last_piece], first_piece):
-                    if piece_status or piece in currently_downloading:
+                for piece in status['pieces'].iter_unset(first_piece, last_piece):
+                    if piece in currently_downloading:
                         continue
 
                     priority = self.torrent.handle.piece_priority(piece)
@@ -360,18 +670,32 @@ class Torrent(object):
                     else:
                         self.torrent.handle.piece_priority(piece, 1)
 
+        if self.prefetches:
+            self.apply_prefetches()
+
     def get_currently_downloading(self):
-        currently_downloading = set()
-        for peer in self.torrent.handle.get_peer_info():
-            if peer.downloading_piece_index != -1:
-                currently_downloading.add(peer.downloading_piece_index)
+        """
+        Pieces in flight, shared by all callers and refreshed at most once per DOWNLOAD_QUEUE_SNAPSHOT_TIME.
+        """
+        with self.download_queue_lock:
+            now = time.time()
+            if self.download_queue_snapshot is None or self.download_queue_updated + DOWNLOAD_QUEUE_SNAPSHOT_TIME < now:
+                self.download_queue_snapshot = self.get_download_queue()
+                self.download_queue_updated = now
+            return self.download_queue_snapshot
+
+    def get_download_queue(self):
+        try:
+            return frozenset(piece['piece_index'] for piece in self.torrent.handle.get_download_queue())
+        except (AttributeError, KeyError, TypeError):
+            logger.debug('Download queue not available, falling back to peer info')
 
-        return currently_downloading
+        return frozenset(peer.downloading_piece_index for peer in self.torrent.handle.get_peer_info()
+                         if peer.downloading_piece_index != -1)
 
     def reset_priorities(self):
-        status = self.torrent.get_status(['pieces'])
-        for piece in range(len(self.torrent.status.pieces)):
-            self.torrent.handle.piece_priority(piece, 1)
+        pieces = self.get_status(['pieces'])['pieces']
+        self.torrent.handle.prioritize_pieces([1] * len(pieces))
 
         self.torrent.set_file_priorities([1] * len(self.torrent.get_file_priorities()))
 
@@ -379,37 +703,391 @@ class Torrent(object):
         logger.debug('Shutting down torrent %r' % (self, ))
         for reader in self.readers.keys():
             reactor.callInThread(reader.close)
+        self.fanout.clear()
+        if self.stall_controller.stalled_since is not None:
+            self.stall_controller.stop_boost()
 
     def add_fileset(self, fileset):
-        files = [f.path for f in fileset]
+        self.add_fileset_paths([f.path for f in fileset])
+
+    def add_fileset_paths(self, files, started=False):
         fileset_hash = hash(','.join(files))
 
         if fileset_hash not in self.filesets:
-            self.filesets[fileset_hash] = {'started': False, 'files': files}
+            self.filesets[fileset_hash] = {'started': started, 'files': files}
+
+    def add_resume_point(self, path, from_byte, to_byte):
+        """
+        Prefetch from where a reader was before a restart, it is upgraded like
+        any other prefetch when the reader comes back.
+        """
+        to_byte = min(from_byte + RESUME_PREFETCH_SIZE, to_byte)
+        if from_byte >= to_byte:
+            return
+
+        self.prefetches[path] = {
+            'from_byte': from_byte,
+            'to_byte': to_byte,
+            'tail_byte': from_byte,
+            'end_byte': to_byte,
+            'expires': datetime.now() + PREFETCH_IDLE_TIMEOUT,
+        }
+        self.prioritize_pieces(from_byte // self.piece_length, (to_byte - 1) // self.piece_length)
+
+    def get_state(self):
+        readers = []
+        for reader, (path, from_byte, to_byte) in list(self.readers.items()):
+            if getattr(reader, 'tell', lambda: None)() is not None:
+                from_byte = reader.offset + reader.tell()
+            readers.append({'path': path, 'from_byte': from_byte, 'to_byte': to_byte})
+
+        prefetches = []
+        for path, prefetch in list(self.prefetches.items()):
+            prefetch = dict((k, v) for k, v in prefetch.items() if k != 'expires')
+            prefetch['path'] = path
+            prefetches.append(prefetch)
+
+        return {
+            'filesets': [fileset['files'] for fileset in self.filesets.values()],
+            'readers': readers,
+            'prefetches': prefetches,
+            'file_priorities': list(self.torrent.get_file_priorities()),
+            'weight': self.weight,
+        }
+
+    def restore_state(self, state):
+        for files in state.get('filesets', []):
+            self.add_fileset_paths(files, started=True)
+
+        file_priorities = state.get('file_priorities')
+        if file_priorities and len(file_priorities) == len(self.torrent.get_file_priorities()):
+            self.torrent.set_file_priorities(file_priorities)
 
-    def request_piece(self, piece):
-        self.torrent.handle.read_piece(piece)
+        self.weight = state.get('weight', 1)
+
+        for prefetch in state.get('prefetches', []):
+            path = prefetch.pop('path')
+            prefetch['expires'] = datetime.now() + PREFETCH_IDLE_TIMEOUT
+            self.prefetches[path] = prefetch
+
+        for reader in state.get('readers', []):
+            self.add_resume_point(reader['path'], reader['from_byte'], reader['to_byte'])
+
+        if self.filesets or self.prefetches:
+            self.ensure_started()
+            self.cycle()
+
+    def prioritize_file_head(self, path, piece_count=FILE_HEAD_PIECE_COUNT):
+        status = self.get_status(['files'])
+        for f in status['files']:
+            if f['path'] != path:
+                continue
+
+            first_piece = f['offset'] // self.piece_length
+            last_piece = (f['offset'] + f['size']) // self.piece_length
+            self.prioritize_pieces(first_piece, last_piece, piece_count)
+            break
+
+    def prioritize_pieces(self, first_piece, last_piece, piece_count=FILE_HEAD_PIECE_COUNT):
+        for piece in range(first_piece, min(first_piece + piece_count, last_piece + 1)):
+            self.torrent.handle.set_piece_deadline(piece, 0)
+            self.torrent.handle.piece_priority(piece, MAX_PIECE_PRIORITY)
+
+    def apply_allocation(self, allocated_rate):
+        """
+        Set deadlines on the upcoming pieces of each reader, spaced by how fast
+        the scheduler expects this torrent to be able to download them.
+        """
+        self.allocated_rate = allocated_rate
+        if not allocated_rate:
+            return
+
+        spacing = int(1000 * self.piece_length / allocated_rate)
+        pieces = self.get_status(['pieces'])['pieces']
+        for reader, (path, from_byte, to_byte) in list(self.readers.items()):
+            if getattr(reader, 'tell', lambda: None)() is None:
+                continue
+
+            current_piece = reader.current_piece[0]
+            last_piece = min((to_byte - 1) // self.piece_length, current_piece + SCHEDULER_DEADLINE_PIECES - 1)
+            for i, piece in enumerate(range(current_piece, last_piece + 1)):
+                if not pieces[piece]:
+                    self.torrent.handle.set_piece_deadline(piece, i * spacing)
+
+    def has_missing_upcoming_pieces(self):
+        """
+        If any reader still needs to download one of the pieces the scheduler sets deadlines on.
+        """
+        pieces = self.get_status(['pieces'])['pieces']
+        for reader, (path, from_byte, to_byte) in list(self.readers.items()):
+            if getattr(reader, 'tell', lambda: None)() is None:
+                continue
+
+            current_piece = reader.current_piece[0]
+            last_piece = min((to_byte - 1) // self.piece_length, current_piece + SCHEDULER_DEADLINE_PIECES - 1)
+            if not pieces.all_set(current_piece, last_piece + 1):
+                return True
+        return False
+
+    def get_reader_position(self, reader, from_byte):
+        if getattr(reader, 'tell', lambda: None)() is None:
+            return from_byte
+        return reader.offset + reader.tell()
+
+    def get_rar_index(self, files):
+        """
+        Index of a fileset made of rar volumes, loaded from the cache or created empty.
+        """
+        if len(files) < 2 or not all(is_rar_volume(path) for path in files):
+            return None
+
+        key = ','.join(files)
+        if key not in self.rar_indexes:
+            rar_index_cache = self.torrent_handler.rar_index_cache
+            index = rar_index_cache and rar_index_cache.load(self.infohash, files)
+            self.rar_indexes[key] = index or RarIndex(files)
+        return self.rar_indexes[key]
+
+    @defer.inlineCallbacks
+    def update_rar_indexes(self):
+        """
+        Read the headers of the rar volumes with a downloaded head and save complete indexes.
+        The files are read in a thread, an update still running is not started again.
+        """
+        indexes = [self.get_rar_index(fileset['files']) for fileset in list(self.filesets.values())]
+        indexes = [index for index in indexes if index is not None and not index.is_complete()]
+        if not indexes or self.updating_rar_indexes:
+            return
+
+        self.updating_rar_indexes = True
+        try:
+            status = self.get_status(['files', 'save_path', 'pieces'])
+            pieces = status['pieces']
+            files = dict((f['path'], f) for f in status['files'])
+            for index in indexes:
+                for path in index.paths:
+                    f = files.get(path)
+                    if path in index.volumes or f is None:
+                        continue
+
+                    head_end = f['offset'] + min(f['size'], HEADER_READ_SIZE)
+                    if not pieces.all_set(f['offset'] // self.piece_length, (head_end - 1) // self.piece_length + 1):
+                        continue
+
+                    try:
+                        data_offset, data_size = yield threads.deferToThread(read_volume, os.path.join(status['save_path'], path))
+                    except (IOError, RarIndexError) as e:
+                        logger.debug('Unable to read rar header of %s: %s' % (path, e))
+                        continue
+
+                    logger.debug('Rar volume %s has %s bytes of data from %s' % (path, data_size, data_offset))
+                    index.add_volume(path, data_offset, data_size)
+
+                if index.is_complete() and self.torrent_handler.rar_index_cache:
+                    yield threads.deferToThread(self.torrent_handler.rar_index_cache.save, self.infohash, index)
+        finally:
+            self.updating_rar_indexes = False
+
+    def prefetch_next_rar_volumes(self):
+        """
+        Prioritize the head of the next rar volume before a reader gets to the end of the current one.
+        A volume is prioritized again once no reader is on the volume before it.
+        """
+        readers = list(self.readers.items())
+        wanted_volumes = set()
+        for reader, (path, from_byte, to_byte) in readers:
+            for fileset in list(self.filesets.values()):
+                index = path in fileset['files'] and self.get_rar_index(fileset['files'])
+                next_path = index and index.get_next_path(path)
+                if next_path:
+                    wanted_volumes.add(next_path)
+        self.prefetched_volumes &= wanted_volumes
+
+        for reader, (path, from_byte, to_byte) in readers:
+            if to_byte - self.get_reader_position(reader, from_byte) > RAR_NEXT_VOLUME_PREFETCH_DISTANCE:
+                continue
+
+            for fileset in list(self.filesets.values()):
+                if path not in fileset['files']:
+                    continue
+
+                index = self.get_rar_index(fileset['files'])
+                next_path = index and index.get_next_path(path)
+                if not next_path or next_path in self.prefetched_volumes:
+                    continue
+
+                f = self.get_file_from_path(next_path)
+                if f is None:
+                    continue
+
+                head_size = HEADER_READ_SIZE
+                if next_path in index.volumes:
+                    head_size = index.volumes[next_path]['data_offset'] + RAR_NEXT_VOLUME_HEAD_SIZE
+
+                logger.debug('Reader is close to the end of %s, prioritizing the head of %s' % (path, next_path))
+                first_piece = f['offset'] // self.piece_length
+                last_piece = (f['offset'] + min(head_size, f['size']) - 1) // self.piece_length
+                self.prioritize_pieces(first_piece, last_piece, last_piece - first_piece + 1)
+                self.prefetched_volumes.add(next_path)
+
+    def get_lookahead_budget(self, reader):
+        bitrate = getattr(reader, 'get_bitrate', lambda: 0)()
+        return max(self.torrent_handler.lookahead_bytes, int(bitrate * self.torrent_handler.lookahead_seconds))
+
+    def extend_lookahead(self):
+        """
+        When the lookahead budget of a reader reaches past the end of its file, set deadlines
+        on the first pieces of the next files in the fileset so there is no stall at the boundary.
+        """
+        files = None
+        for reader, (path, from_byte, to_byte) in list(self.readers.items()):
+            bytes_ahead = to_byte - self.get_reader_position(reader, from_byte)
+            remaining = self.get_lookahead_budget(reader) - bytes_ahead
+            if remaining <= 0:
+                continue
+
+            rate = getattr(reader, 'get_bitrate', lambda: 0)() or self.allocated_rate
+            for fileset in list(self.filesets.values()):
+                if path not in fileset['files']:
+                    continue
+
+                if files is None:
+                    status = self.get_status(['files', 'pieces'])
+                    files = dict((f['path'], f) for f in status['files'])
+                    pieces = status['pieces']
+
+                fileset_remaining = remaining
+                fileset_bytes_ahead = bytes_ahead
+                for next_path in fileset['files'][fileset['files'].index(path) + 1:]:
+                    f = files.get(next_path)
+                    if fileset_remaining <= 0 or f is None:
+                        break
+
+                    size = min(f['size'], fileset_remaining)
+                    first_piece = f['offset'] // self.piece_length
+                    last_piece = (f['offset'] + max(size, 1) - 1) // self.piece_length
+                    for i, piece in enumerate(range(first_piece, last_piece + 1)):
+                        if pieces[piece]:
+                            continue
+
+                        if rate:
+                            deadline = int(1000 * (fileset_bytes_ahead + i * self.piece_length) / rate)
+                        else:
+                            deadline = (i + 1) * LOOKAHEAD_DEADLINE_SPACING
+                        self.torrent.handle.set_piece_deadline(piece, deadline)
+
+                    fileset_remaining -= size
+                    fileset_bytes_ahead += f['size']
+
+    def get_rar_prefetch_ranges(self, files, size):
+        """
+        Volume byte ranges holding the first size bytes of the packed file, None if the layout is not known yet.
+        """
+        index = self.get_rar_index(files)
+        if index is None or not index.is_complete():
+            return None
+        return index.get_ranges(0, size)
+
+    def update_lookahead(self):
+        def log_rar_index_error(failure):
+            logger.error('Failed to update rar indexes of %s: %s' % (self.infohash, failure.getTraceback()))
+
+        self.update_rar_indexes().addErrback(log_rar_index_error)
+        if self.readers:
+            self.extend_lookahead()
+        self.prefetch_next_rar_volumes()
+
+    def get_fanout_window(self):
+        return self.torrent_handler.fanout_window // self.piece_length
+
+    def get_fanout_status(self):
+        playheads = get_playheads(list(self.readers.keys()))
+        status = self.fanout.get_status()
+        status['readers'] = len(playheads)
+        status['attached_readers'] = len(get_attached_readers(playheads, self.get_fanout_window()))
+        return status
+
+    def request_piece(self, piece, reader):
+        data, read_needed = self.fanout.request(piece)
+        if data is not None:
+            logger.debug('Piece %s shared with reader %s' % (piece, reader))
+            reader.new_piece_available(piece, data)
+        elif read_needed:
+            self.torrent.handle.read_piece(piece)
 
     def new_piece_available(self, piece, data):
         logger.debug("New pice available: %s" % (piece, ))
-        for reader in self.readers.keys():
+        readers = list(self.readers.keys())
+        self.fanout.piece_read(piece, data, get_playheads(readers), self.get_fanout_window())
+        for reader in readers:
             reader.new_piece_available(piece, data)
 
 
 class TorrentHandler(object):
-    def __init__(self, reset_priorities_on_finish, aggressive_prioritizing=False):
+    def __init__(self, reset_priorities_on_finish, aggressive_prioritizing=False, metadata_timeout=60, scheduler_capacity=0, use_scheduler=True,
+                 buffer_memory_limit=0, state_path=None, rar_index_path=None, lookahead_bytes=0, lookahead_seconds=0, fanout_window=0,
+                 read_stall_timeout=0, stall_tuning=None):
         self.torrents = {}
+        self.stall_tuning = stall_tuning
+        self.fanout_window = fanout_window
+        self.read_stall_timeout = read_stall_timeout
+        self.reaped_readers = 0
+        self.lookahead_bytes = lookahead_bytes
+        self.lookahead_seconds = lookahead_seconds
+        self.rar_index_cache = rar_index_path and RarIndexCache(rar_index_path)
+        self.last_saved_state = None
+        self.pending_restores = {}
+        self.restore_timeout = None
+        self.metadata_waiters = {}
         self.reset_priorities_on_finish = reset_priorities_on_finish
         self.aggressive_prioritizing = aggressive_prioritizing
+        self.metadata_timeout = metadata_timeout
+        self.buffer_pool = BufferPool(buffer_memory_limit)
 
         self.alerts = component.get("AlertManager")
         self.alerts.register_handler("torrent_removed_alert", self.on_alert_torrent_removed)
         self.alerts.register_handler("torrent_finished_alert", self.on_alert_torrent_finished)
         self.alerts.register_handler("read_piece_alert", self.on_alert_read_piece)
+        self.alerts.register_handler("metadata_received_alert", self.on_alert_metadata_received)
+        self.alerts.register_handler("file_renamed_alert", self.on_alert_file_renamed)
 
         self.cleanup_looping_call = task.LoopingCall(self.cleanup)
         self.cleanup_looping_call.start(60)
 
+        self.lookahead_looping_call = task.LoopingCall(self.update_lookahead)
+        self.lookahead_looping_call.start(LOOKAHEAD_INTERVAL)
+
+        self.reap_looping_call = task.LoopingCall(self.reap_stalled_readers)
+        self.reap_looping_call.start(READER_REAP_INTERVAL)
+
+        self.stall_looping_call = task.LoopingCall(self.update_stall_controllers)
+        self.stall_looping_call.start(STALL_CHECK_INTERVAL)
+
+        self.scheduler = StreamScheduler(self, scheduler_capacity)
+        self.set_use_scheduler(use_scheduler)
+
+        self.save_state_looping_call = task.LoopingCall(self.save_state)
+        self.set_state_path(state_path)
+
+    def set_prioritization(self, reset_priorities_on_finish, aggressive_prioritizing):
+        self.reset_priorities_on_finish = reset_priorities_on_finish
+        self.aggressive_prioritizing = aggressive_prioritizing
+        for torrent in list(self.torrents.values()):
+            torrent.aggressive_prioritizing = aggressive_prioritizing
+
+    def set_use_scheduler(self, use_scheduler):
+        if use_scheduler and not self.scheduler.looping_call.running:
+            self.scheduler.start()
+        elif not use_scheduler and self.scheduler.looping_call.running:
+            self.scheduler.stop()
+
+    def set_state_path(self, state_path):
+        self.state_path = state_path
+        if state_path and not self.save_state_looping_call.running:
+            self.save_state_looping_call.start(STATE_SAVE_INTERVAL, now=False)
+        elif not state_path and self.save_state_looping_call.running:
+            self.save_state_looping_call.stop()
+
     def on_alert_torrent_removed(self, alert):
         try:
             infohash = str(alert.handle.info_hash())
@@ -448,17 +1126,175 @@ class TorrentHandler(object):
 
         self.torrents[infohash].new_piece_available(alert.piece, alert.buffer)
 
+    def on_alert_metadata_received(self, alert):
+        try:
+            infohash = str(alert.handle.info_hash())
+        except (RuntimeError, KeyError):
+            logger.warning('Failed to handle on metadata received alert')
+            return
+
+        for d in self.metadata_waiters.pop(infohash, []):
+            d.callback(None)
+
+        if infohash in self.pending_restores:
+            self.restore_pending_state()
+
+    def on_alert_file_renamed(self, alert):
+        try:
+            infohash = str(alert.handle.info_hash())
+        except (RuntimeError, KeyError):
+            logger.warning('Failed to handle on file renamed alert')
+            return
+
+        if infohash in self.torrents:
+            self.torrents[infohash].invalidate_status('files')
+
+    def wait_for_metadata(self, infohash):
+        """
+        Returns a Deferred that fires when the torrent has metadata.
+        """
+        torrent = get_torrent(infohash)
+        if torrent.handle.has_metadata():
+            return defer.succeed(None)
+
+        logger.debug('Waiting for metadata for %s' % (infohash, ))
+        d = defer.Deferred()
+        self.metadata_waiters.setdefault(infohash, []).append(d)
+
+        def remove_waiter(result):
+            waiters = self.metadata_waiters.get(infohash, [])
+            if d in waiters:
+                waiters.remove(d)
+            if not waiters:
+                self.metadata_waiters.pop(infohash, None)
+            return result
+
+        d.addTimeout(self.metadata_timeout, reactor)
+        d.addBoth(remove_waiter)
+        return d
+
+    def save_state(self):
+        if not self.state_path:
+            return
+
+        try:
+            torrents = dict(self.pending_restores)  # kept in case Deluge restarts before they are restored
+            torrents.update((infohash, torrent.get_state()) for infohash, torrent in list(self.torrents.items()))
+        except:
+            logger.exception('Failed to collect stream state')
+            return
+
+        if torrents == self.last_saved_state:
+            return
+
+        save_state(self.state_path, {'saved': time.time(), 'torrents': torrents})
+        self.last_saved_state = torrents
+
+    def restore_state(self):
+        """
+        Bring back the streams that were active when the state was saved so their
+        prioritization does not have to be rebuilt when the viewers reconnect.
+
+        The plugin is enabled before Deluge loads its torrents, the saved streams are
+        restored as their torrents are added and have metadata. Streams whose torrent
+        does not show up within STATE_RESTORE_TIMEOUT are dropped.
+        """
+        if not self.state_path:
+            return
+
+        state = load_state(self.state_path)
+        if not state or state.get('saved', 0) + STATE_MAX_AGE < time.time():
+            return
+
+        self.pending_restores = dict(state.get('torrents', {}))
+        if not self.pending_restores:
+            return
+
+        logger.info('Restoring the state of %s streams when their torrents are loaded' % (len(self.pending_restores), ))
+        event_manager = component.get('EventManager')
+        event_manager.register_event_handler('TorrentAddedEvent', self.on_torrent_added)
+        event_manager.register_event_handler('SessionStartedEvent', self.on_session_started)
+        self.restore_timeout = reactor.callLater(STATE_RESTORE_TIMEOUT, self.stop_restoring_state)
+        self.restore_pending_state()
+
+    def on_torrent_added(self, infohash, *args):
+        if infohash in self.pending_restores:
+            self.restore_pending_state()
+
+    def on_session_started(self, *args):
+        """
+        All torrents are loaded now, saved streams without a torrent will never be restored.
+        """
+        self.restore_pending_state()
+        for infohash in [infohash for infohash in self.pending_restores if get_torrent(infohash) is None]:
+            logger.info('Not restoring the stream state of %s, the torrent is gone' % (infohash, ))
+            del self.pending_restores[infohash]
+
+        if not self.pending_restores:
+            self.stop_restoring_state()
+
+    def restore_pending_state(self):
+        for infohash, torrent_state in list(self.pending_restores.items()):
+            torrent = get_torrent(infohash)
+            if torrent is None or not torrent.handle.has_metadata():
+                continue
+
+            del self.pending_restores[infohash]
+            logger.debug('Restoring stream state of %s' % (infohash, ))
+            try:
+                self.get_torrent(infohash).restore_state(torrent_state)
+            except:
+                logger.exception('Failed to restore stream state of %s' % (infohash, ))
+
+        if not self.pending_restores:
+            self.stop_restoring_state()
+
+    def stop_restoring_state(self):
+        for infohash in self.pending_restores:
+            logger.info('Not restoring the stream state of %s, the torrent or its metadata did not show up' % (infohash, ))
+        self.pending_restores = {}
+
+        if self.restore_timeout is not None:
+            if self.restore_timeout.active():
+                self.restore_timeout.cancel()
+            self.restore_timeout = None
+
+            event_manager = component.get('EventManager')
+            event_manager.deregister_event_handler('TorrentAddedEvent', self.on_torrent_added)
+            event_manager.deregister_event_handler('SessionStartedEvent', self.on_session_started)
+
     def shutdown(self):
+        self.stop_restoring_state()
+        self.save_state()
+        if self.save_state_looping_call.running:
+            self.save_state_looping_call.stop()
+
         for torrent in self.torrents.values():
             if self.reset_priorities_on_finish:
                 torrent.reset_priorities()
             torrent.shutdown()
 
+        for waiters in self.metadata_waiters.values():
+            for d in waiters:
+                d.cancel()
+
+        self.alerts.deregister_handler(self.on_alert_torrent_removed)
+        self.alerts.deregister_handler(self.on_alert_torrent_finished)
+        self.alerts.deregister_handler(self.on_alert_read_piece)
+        self.alerts.deregister_handler(self.on_alert_metadata_received)
+        self.alerts.deregister_handler(self.on_alert_file_renamed)
+
         self.cleanup_looping_call.stop()
+        self.lookahead_looping_call.stop()
+        self.reap_looping_call.stop()
+        self.stall_looping_call.stop()
+        self.scheduler.stop()
 
     def get_filesystem(self, infohash):
-        torrent = get_torrent(infohash)
-        status = torrent.get_status(['files', 'file_progress', 'save_path'])
+        from thomas import Item
+        register_thomas_handlers()
+
+        status = self.get_torrent(infohash).get_status(['files', 'file_progress', 'save_path'])
         save_path = status['save_path']
 
         found_rar = False
@@ -514,24 +1350,36 @@ class TorrentHandler(object):
         item.parent_item = None
         return item
 
-    def get_torrent(self, infohash):
-        if infohash not in self.torrents:
-            self.torrents[infohash] = Torrent(self, infohash, self.aggressive_prioritizing)
-        return self.torrents[infohash]
+    def get_completed_path(self, infohash, stream_result):
+        """
+        Full path of what is streamed if it is a single completely downloaded file, otherwise None.
+        """
+        if hasattr(stream_result, 'get_read_items'):
+            fileset = stream_result.get_read_items()
+        else:
+            fileset = [stream_result]
 
-    @defer.inlineCallbacks
-    def stream(self, infohash, path, wait_for_end_pieces=False):
-        logger.debug('Trying to get path:%s from infohash:%s' % (path, infohash))
-        torrent = get_torrent(infohash)
+        if len(fileset) != 1:
+            return None
 
-        for _ in range(10):
-            status = torrent.get_status(['piece_length'])
-            if status['piece_length'] > 0:
+        status = self.get_torrent(infohash).get_status(['files', 'file_progress', 'save_path'])
+        for f, progress in zip(status['files'], status['file_progress']):
+            if f['path'] == getattr(fileset[0], 'path', None):
+                if progress == 1.0:
+                    return os.path.join(status['save_path'], f['path'])
                 break
-            yield sleep(0.2)
 
-        local_torrent = self.get_torrent(infohash)
+        return None
+
+    def get_torrent(self, infohash):
+        if infohash not in self.torrents:
+            self.torrents[infohash] = Torrent(self, infohash, self.aggressive_prioritizing)
+        return self.torrents[infohash]
 
+    def resolve_stream(self, infohash, path):
+        """
+        Find what to stream for a path, returns the stream result and the files it reads from.
+        """
         filesystem = self.get_filesystem(infohash)
         if path:
             stream_item = filesystem.get_item_from_path(path)
@@ -542,26 +1390,81 @@ class TorrentHandler(object):
 
         logger.debug('Stream, path:%s infohash:%s stream_item:%r' % (path, infohash, stream_item))
         if stream_item is None:
-            defer.returnValue(None)
+            return None, None
 
         stream_result = stream_item.stream()
         logger.debug('Streamresult, path:%s infohash:%s stream_result:%r' % (path, infohash, stream_result))
         if stream_result is None:
-            defer.returnValue(None)
+            return None, None
 
         if hasattr(stream_result, 'get_read_items'):
             fileset = stream_result.get_read_items()
         else:
             fileset = [stream_result]
+
+        return stream_result, fileset
+
+    @defer.inlineCallbacks
+    def prefetch(self, infohash, path, size):
+        """
+        Start downloading the head of what would be streamed from path, returns the path prefetched and the size.
+        """
+        torrent = get_torrent(infohash)
+        if not torrent.handle.has_metadata():
+            try:
+                yield self.wait_for_metadata(infohash)
+            except defer.TimeoutError:
+                raise StreamError('timeout while waiting for torrent metadata')
+
+        stream_result, fileset = self.resolve_stream(infohash, path)
+        if stream_result is None:
+            raise StreamError('nothing to prefetch')
+
+        local_torrent = self.get_torrent(infohash)
+        prefetch_path = fileset[0].path
+        rar_ranges = local_torrent.get_rar_prefetch_ranges([f.path for f in fileset], size)
+        if rar_ranges:
+            for path, start, end in rar_ranges:
+                local_torrent.add_prefetch(path, end)
+        else:
+            size = local_torrent.add_prefetch(prefetch_path, size)
+        if size is None:
+            raise StreamError('nothing to prefetch')
+
+        defer.returnValue((prefetch_path, size))
+
+    @defer.inlineCallbacks
+    def stream(self, infohash, path, wait_for_end_pieces=False):
+        logger.debug('Trying to get path:%s from infohash:%s' % (path, infohash))
+        torrent = get_torrent(infohash)
+
+        waited_for_metadata = not torrent.handle.has_metadata()
+        if waited_for_metadata:
+            try:
+                yield self.wait_for_metadata(infohash)
+            except defer.TimeoutError:
+                raise StreamError('timeout while waiting for torrent metadata')
+
+        local_torrent = self.get_torrent(infohash)
+
+        stream_result, fileset = self.resolve_stream(infohash, path)
+        if stream_result is None:
+            defer.returnValue(None)
+
         self.torrents[infohash].add_fileset(fileset)
 
+        if waited_for_metadata:
+            logger.debug('Metadata just arrived, prioritizing the head of %s right away' % (fileset[0].path, ))
+            local_torrent.cycle()
+            local_torrent.prioritize_file_head(fileset[0].path)
+
         if wait_for_end_pieces:
             local_torrent.ensure_started()
             logger.debug('We need to wait for pieces')
             first_file = fileset[0]
             last_file = fileset[-1]
 
-            status = torrent.get_status(['piece_length', 'files', 'file_progress'])
+            status = local_torrent.get_status(['piece_length', 'files', 'file_progress'])
             piece_length = status['piece_length']
 
             wait_for_pieces = []
@@ -593,9 +1496,9 @@ class TorrentHandler(object):
                     torrent.handle.piece_priority(piece, MAX_PIECE_PRIORITY)
 
             for _ in range(220):
-                status = torrent.get_status(['pieces'])
+                pieces = local_torrent.get_status(['pieces'])['pieces']
                 for piece in wait_for_pieces:
-                    if not torrent.status.pieces[piece]:
+                    if not pieces[piece]:
                         break
                 else:
                     break
@@ -604,8 +1507,70 @@ class TorrentHandler(object):
 
         defer.returnValue(stream_result)
 
+    def update_lookahead(self):
+        for infohash, torrent in list(self.torrents.items()):
+            try:
+                torrent.update_lookahead()
+            except:
+                logger.exception('Failed to update lookahead of %s' % (infohash, ))
+
+    def update_stall_controllers(self):
+        """
+        Boosts torrents with stalled readers and restores the torrents whose stall cleared or when stall tuning is off.
+        """
+        for infohash, torrent in list(self.torrents.items()):
+            controller = torrent.stall_controller
+            try:
+                if self.stall_tuning:
+                    controller.update(self.stall_tuning['threshold'], self.stall_tuning['max_connections'],
+                                      self.stall_tuning['upload_slots'])
+                elif controller.stalled_since is not None:
+                    controller.stop_boost()
+            except:
+                logger.exception('Failed to update stall controller of %s' % (infohash, ))
+
+    def get_stall_status(self):
+        return [torrent.stall_controller.get_status() for torrent in list(self.torrents.values())
+                if torrent.stall_controller.stalls]
+
+    def reap_stalled_readers(self):
+        """
+        Closes readers that have waited for data longer than read_stall_timeout,
+        their waiting reads return right away.
+        """
+        if not self.read_stall_timeout:
+            return
+
+        for infohash, torrent in list(self.torrents.items()):
+            for reader in list(torrent.readers.keys()):
+                waiting_time = reader.get_waiting_time()
+                if waiting_time > self.read_stall_timeout:
+                    logger.warning('Closing reader %r of %s, it has waited %.0f seconds for data' % (reader, infohash, waiting_time))
+                    self.reaped_readers += 1
+                    reader.close()
+
+    def get_reader_status(self):
+        readers = [reader for torrent in list(self.torrents.values()) for reader in list(torrent.readers.keys())]
+        return {
+            'active': len(readers),
+            'waiting': len([reader for reader in readers if reader.get_waiting_time()]),
+            'reaped': self.reaped_readers,
+            'stall_timeout': self.read_stall_timeout,
+        }
+
+    def get_fanout_status(self):
+        status = {'readers': 0, 'attached_readers': 0, 'kept_pieces': 0, 'kept_bytes': 0, 'reads': 0, 'shared_reads': 0}
+        for torrent in list(self.torrents.values()):
+            for key, value in torrent.get_fanout_status().items():
+                status[key] += value
+        status['window'] = self.fanout_window
+        return status
+
     def cleanup(self):
-        for infohash, torrent in self.torrents.items():
+        for torrent in self.torrents.values():
+            torrent.expire_prefetches()
+
+        for infohash, torrent in list(self.torrents.items()):
             if torrent.is_idle():
                 logger.debug('Torrent %s is idle, killing it' % (torrent, ))
                 torrent.shutdown()
@@ -640,6 +1605,12 @@ class StreamResource(Resource):
         self.client = client
         Resource.__init__(self, *args, **kwargs)
 
+    def render_result(self, request, result):
+        if result.get('status') == 'busy':
+            request.setResponseCode(503)
+            request.setHeader(b'Retry-After', str(result['retry_after']).encode('ascii'))
+        return json.dumps(result).encode('utf-8')
+
     @defer.inlineCallbacks
     def render_POST(self, request):
         infohash = request.args.get(b'infohash')
@@ -666,15 +1637,56 @@ class StreamResource(Resource):
         if not payload:
             defer.returnValue(json.dumps({'status': 'error', 'message': 'invalid torrent'}).encode('utf-8'))
 
-        result = yield self.client.stream_torrent(infohash=infohash, filedump=payload, filepath_or_index=path, wait_for_end_pieces=wait_for_end_pieces, label=label)
-        defer.returnValue(json.dumps(result).encode('utf-8'))
+        result = yield self.client.stream_torrent(infohash=infohash, filedump=payload, filepath_or_index=path, wait_for_end_pieces=wait_for_end_pieces, label=label,
+                                                  client_ip=self.client.get_client_ip(request))
+        defer.returnValue(self.render_result(request, result))
 
     @defer.inlineCallbacks
     def render_GET(self, request):
         infohash = request.args.get(b'infohash')
+        url = request.args.get(b'url')
         path = request.args.get(b'path')
         wait_for_end_pieces = bool(request.args.get(b'wait_for_end_pieces'))
 
+        if not infohash and not url:
+            defer.returnValue(json.dumps({'status': 'error', 'message': 'missing infohash'}).encode('utf-8'))
+
+        if infohash:
+            infohash = infohash[0].decode('utf-8')
+        else:
+            infohash = None
+
+        if url:
+            url = url[0].decode('utf-8')
+            error_message = self.client.check_http_api_url(url)
+            if error_message:
+                defer.returnValue(json.dumps({'status': 'error', 'message': error_message}).encode('utf-8'))
+        else:
+            url = None
+
+        if path:
+            path = path[0].decode('utf-8')
+        else:
+            path = None
+
+        result = yield self.client.stream_torrent(infohash=infohash, url=url, filepath_or_index=path, wait_for_end_pieces=wait_for_end_pieces,
+                                                  client_ip=self.client.get_client_ip(request))
+        defer.returnValue(self.render_result(request, result))
+
+
+class PrefetchResource(Resource):
+    isLeaf = True
+
+    def __init__(self, client, *args, **kwargs):
+        self.client = client
+        Resource.__init__(self, *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def render_GET(self, request):
+        infohash = request.args.get(b'infohash')
+        path = request.args.get(b'path')
+        size = request.args.get(b'size')
+
         if not infohash:
             defer.returnValue(json.dumps({'status': 'error', 'message': 'missing infohash'}).encode('utf-8'))
 
@@ -685,17 +1697,87 @@ class StreamResource(Resource):
         else:
             path = None
 
-        result = yield self.client.stream_torrent(infohash=infohash, filepath_or_index=path, wait_for_end_pieces=wait_for_end_pieces)
+        if size:
+            size = size[0].decode('utf-8')
+        else:
+            size = None
+
+        result = yield self.client.prefetch(infohash, path, size)
         defer.returnValue(json.dumps(result).encode('utf-8'))
 
 
+class BatchStreamResource(Resource):
+    isLeaf = True
+
+    def __init__(self, client, *args, **kwargs):
+        self.client = client
+        Resource.__init__(self, *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def render_POST(self, request):
+        try:
+            payload = json.loads(request.content.read().decode('utf-8'))
+        except ValueError:
+            defer.returnValue(json.dumps({'status': 'error', 'message': 'invalid json'}).encode('utf-8'))
+
+        if isinstance(payload, dict):
+            entries = payload.get('entries')
+            wait_for_end_pieces = bool(payload.get('wait_for_end_pieces'))
+        else:
+            entries = payload
+            wait_for_end_pieces = False
+
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            defer.returnValue(json.dumps({'status': 'error', 'message': 'entries must be a list of objects'}).encode('utf-8'))
+
+        try:
+            for entry in entries:
+                if entry.get('torrent'):
+                    entry['filedump'] = base64.b64decode(entry.pop('torrent'))
+        except (TypeError, ValueError):
+            defer.returnValue(json.dumps({'status': 'error', 'message': 'invalid base64 encoded torrent'}).encode('utf-8'))
+
+        for entry in entries:
+            error_message = entry.get('url') and self.client.check_http_api_url(entry['url'])
+            if error_message:
+                defer.returnValue(json.dumps({'status': 'error', 'message': error_message}).encode('utf-8'))
+
+        request.setHeader(b'content-type', b'application/x-ndjson')
+
+        def write_result(result):
+            if not request.finished:
+                request.write(json.dumps(result).encode('utf-8') + b'\n')
+
+        results = self.client.stream_batch(entries, wait_for_end_pieces=wait_for_end_pieces,
+                                           client_ip=self.client.get_client_ip(request))
+        for d in results:
+            d.addCallback(write_result)
+
+        yield defer.DeferredList(results)
+        defer.returnValue(b'')
+
+
 class Core(CorePluginBase):
     listening = None
     base_url = None
+    url_signer = None
+    server_ready = None
+    thomas_http_output = None
+    site = None
+    listen_address = None
+    worker_pool = None
+    completed_signer = None
+
+    remote_resources = [
+        (b'stream', StreamResource),
+        (b'prefetch', PrefetchResource),
+        (b'batch', BatchStreamResource),
+    ]
 
     _is_enabled = False
 
     def enable(self):
+        enable_start = time.time()
         self._is_enabled = True
         self.config = deluge.configmanager.ConfigManager("streaming.conf", DEFAULT_PREFS)
 
@@ -707,29 +1789,85 @@ class Core(CorePluginBase):
         except AttributeError:
             logger.warning('Unable to prioritize partial pieces')
 
-        http_output_cls = OutputBase.find_plugin('http')
-        http_output = http_output_cls(url_prefix='file')
-        http_output.start()
-
-        self.thomas_http_output = http_output
+        self.url_signer = self.build_url_signer()
+        self.completed_signer = self.build_completed_signer()
+
+        self.resource = TwistedResource()
+        self.file_resource = SignedResource(lambda: self.get_http_output().resource)
+        self.resource.putChild(b'file', self.file_resource)
+        self.update_resources()
+
+        state_path = None
+        if self.config['persist_state']:
+            state_path = os.path.join(configmanager.get_config_dir(), STATE_FILENAME)
+
+        self.torrent_handler = TorrentHandler(self.config['download_only_streamed'] == False, self.config['aggressive_prioritizing'],
+                                              metadata_timeout=self.config['magnet_metadata_timeout'],
+                                              scheduler_capacity=self.config['scheduler_capacity'],
+                                              use_scheduler=self.config['use_scheduler'],
+                                              buffer_memory_limit=self.config['buffer_memory_limit'],
+                                              state_path=state_path,
+                                              rar_index_path=configmanager.get_config_dir('streaming_rar_index'),
+                                              lookahead_bytes=self.config['lookahead_bytes'],
+                                              lookahead_seconds=self.config['lookahead_seconds'],
+                                              fanout_window=self.config['fanout_window'],
+                                              read_stall_timeout=self.config['read_stall_timeout'],
+                                              stall_tuning=self.get_stall_tuning())
+        self.torrent_handler.restore_state()
+        self.check_admission_control()
+        self.add_torrent_flights = SingleFlight()
+        self.stream_flights = SingleFlight(memo_time=STREAM_RESULT_MEMO_TIME,
+                                           should_memo=lambda result: result.get('status') == 'success')
+        self.torrent_fetcher = TorrentFetcher(configmanager.get_config_dir('streaming_torrent_cache'),
+                                              max_entries=self.config['torrent_cache_max_entries'],
+                                              max_bytes=self.config['torrent_cache_max_bytes'],
+                                              max_age=self.config['torrent_cache_max_age'],
+                                              timeout=self.config['torrent_fetch_timeout'])
+
+        def log_server_error(failure):
+            logger.error('Failed to set up the streaming server: %s' % (failure.getErrorMessage(), ))
+
+        self.server_ready = task.deferLater(reactor, 0, self.setup_server)
+        self.server_ready.addErrback(log_server_error)
+
+        logger.info('Streaming plugin enabled in %.1fms' % ((time.time() - enable_start) * 1000, ))
+
+    def get_http_output(self):
+        """
+        The thomas http output is created the first time a file is served.
+        """
+        if self.thomas_http_output is None:
+            from thomas import OutputBase
+            register_thomas_handlers()
+
+            http_output_cls = OutputBase.find_plugin('http')
+            http_output = http_output_cls(url_prefix='file')
+            http_output.start()
+            self.thomas_http_output = http_output
+
+        return self.thomas_http_output
+
+    def setup_server(self):
+        """
+        Binds the listener and figures out the base url, runs after enable has returned
+        so the daemon is not held up by it.
+        """
+        from twisted.web import server
 
-        resource = TwistedResource()
-        resource.putChild(b'file', http_output.resource)
-        if self.config['allow_remote']:
-            resource.putChild(b'stream', StreamResource(username=self.config['remote_username'],
-                                                       password=self.config['remote_password'],
-                                                       client=self))
+        if not self._is_enabled:
+            return
 
         base_resource = TwistedResource()
-        base_resource.putChild(b'streaming', resource)
+        base_resource.putChild(b'streaming', self.resource)
         self.site = server.Site(base_resource)
 
-        self.torrent_handler = TorrentHandler(self.config['download_only_streamed'] == False, self.config['aggressive_prioritizing'])
-
         plugin_manager = component.get("CorePluginManager")
-        logger.warning('plugins %s' % (plugin_manager.get_enabled_plugins(), ))
+        logger.debug('plugins %s' % (plugin_manager.get_enabled_plugins(), ))
+
+        self.start_listening()
 
-        self.base_url = 'http'
+    def start_listening(self):
+        scheme = 'http'
         if self.config['serve_method'] == 'standalone':
             if self.config['use_ssl'] and self.check_ssl():  # use default deluge (or webui), input custom
                 if self.config['ssl_source'] == 'daemon':
@@ -749,7 +1887,7 @@ class Core(CorePluginBase):
                         self.listening = reactor.listenSSL(self.config['port'], self.site, context, interface='0.0.0.0')
                     except error.CannotListenError:
                         logger.warning("Unable to listen to anything")
-                self.base_url += 's'
+                scheme += 's'
             else:
                 try:
                     self.listening = reactor.listenTCP(self.config['port'], self.site, interface=self.config['ip'])
@@ -765,36 +1903,88 @@ class Core(CorePluginBase):
             plugin_manager = component.get("CorePluginManager")
 
             webui_plugin = plugin_manager['WebUi'].plugin
-            webui_plugin.server.top_level.putChild('streaming', resource)
+            webui_plugin.server.top_level.putChild('streaming', self.resource)
 
             port = webui_plugin.server.port
             ip = getattr(webui_plugin.server, 'interface', None) or self.config['ip']
             if webui_plugin.server.https:
-                self.base_url += 's'
+                scheme += 's'
+        elif self.config['serve_method'] == 'unix':
+            socket_path = self.get_unix_socket_path()
+            remove_stale_socket(socket_path)
+            try:
+                self.listening = reactor.listenUNIX(socket_path, self.site, mode=self.config['unix_socket_mode'])
+            except error.CannotListenError as e:
+                logger.warning('Unable to listen to %s: %s' % (socket_path, e))
+
+            if not self.config['reverse_proxy_base_url']:
+                logger.warning('Listening to a unix socket without reverse_proxy_base_url set, stream urls will not work')
+
+            ip = 'localhost'
+            port = self.config['port']
         else:
             raise NotImplementedError()
 
-        if self.config['reverse_proxy_enabled'] and self.config['reverse_proxy_base_url']:
-            self.base_url = self.config['reverse_proxy_base_url']
-        else:
-            self.base_url += '://'
-            if ':' in ip:
-                self.base_url += ip
-            else:
-                self.base_url += '%s:%s' % (ip, port)
+        self.listen_address = (scheme, ip, port)
+        self.update_base_url()
+        self.start_workers()
 
-        self.base_url = self.base_url.rstrip('/')
+    def start_workers(self):
+        if not self.config['worker_processes']:
+            return
 
-    @defer.inlineCallbacks
-    def disable(self):
-        if not self._is_enabled:
-            defer.returnValue(None)
+        from .worker import WorkerPool, can_use_workers
+        if not can_use_workers():
+            logger.warning('Worker processes are not supported on this platform')
+            return
 
-        self._is_enabled = False
+        worker_pool = WorkerPool(self.config['worker_processes'], self.config['ip'], self.config['worker_port'],
+                                 self.config['signed_url_secret'],
+                                 bind_ip=self.config['signed_url_bind_ip'],
+                                 trust_forwarded_for=self.trust_forwarded_for())
+        try:
+            worker_pool.start()
+        except socket.error as e:
+            logger.warning('Unable to start workers on port %s: %s' % (self.config['worker_port'], e))
+            worker_pool.stop()
+            return
 
-        self.site.stopFactory()
-        self.torrent_handler.shutdown()
-        self.thomas_http_output.stop()
+        self.worker_pool = worker_pool
+
+    def stop_workers(self):
+        """
+        Returns a Deferred firing when the workers have ended and released the worker port.
+        """
+        worker_pool, self.worker_pool = self.worker_pool, None
+        if worker_pool is None:
+            return defer.succeed(None)
+        return worker_pool.stop()
+
+    def get_unix_socket_path(self):
+        return self.config['unix_socket_path'] or os.path.join(configmanager.get_config_dir(), UNIX_SOCKET_FILENAME)
+
+    def trust_forwarded_for(self):
+        """
+        Behind a reverse proxy the client ip comes from X-Forwarded-For,
+        a unix socket is only reachable through one.
+        """
+        return self.config['reverse_proxy_enabled'] or self.config['serve_method'] == 'unix'
+
+    def get_worker_base_url(self):
+        if self.config['worker_base_url']:
+            return self.config['worker_base_url'].rstrip('/')
+
+        ip = self.config['ip']
+        if ':' in ip:
+            ip = '[%s]' % (ip, )
+        return 'http://%s:%s' % (ip, self.config['worker_port'])
+
+    @defer.inlineCallbacks
+    def stop_listening(self):
+        """
+        Stop accepting new connections, connections already open are left to finish.
+        """
+        yield self.stop_workers()
 
         if self.check_webui():
             plugin_manager = component.get("CorePluginManager")
@@ -809,6 +1999,125 @@ class Core(CorePluginBase):
             yield self.listening.stopListening()
         self.listening = None
 
+    def update_base_url(self):
+        if self.listen_address is None:
+            return
+
+        scheme, ip, port = self.listen_address
+        if self.config['reverse_proxy_base_url'] and (self.config['reverse_proxy_enabled'] or self.config['serve_method'] == 'unix'):
+            base_url = self.config['reverse_proxy_base_url']
+        else:
+            base_url = scheme + '://'
+            if ':' in ip:
+                base_url += ip
+            else:
+                base_url += '%s:%s' % (ip, port)
+
+        self.base_url = base_url.rstrip('/')
+
+    def check_http_api_url(self, url):
+        """
+        Returns why url may not be used through the HTTP API or None. Magnet URIs are always allowed,
+        torrents are only fetched when http_api_fetch_urls is on and only over http and https.
+        """
+        if not isinstance(url, type(u'')):
+            return 'url must be a string'
+
+        if is_magnet(url):
+            return None
+
+        if not self.config['http_api_fetch_urls']:
+            return 'fetching torrents from urls is disabled'
+
+        if url.split(':', 1)[0].lower() not in ('http', 'https'):
+            return 'only http and https urls can be fetched'
+
+        return None
+
+    def check_admission_control(self):
+        if self.config['admission_control'] and not self.config['use_scheduler']:
+            logger.warning('Admission control needs use_scheduler to measure the capacity, every stream is admitted')
+
+    def get_stall_tuning(self):
+        """
+        A dict with threshold, max_connections and upload_slots for the stall controllers, None disables them.
+        """
+        if not self.config['stall_tuning']:
+            return None
+
+        return {
+            'threshold': self.config['stall_threshold'],
+            'max_connections': self.config['stall_max_connections'],
+            'upload_slots': self.config['stall_upload_slots'],
+        }
+
+    def build_completed_signer(self):
+        """
+        Urls to completed files are always signed, they contain the path of the file.
+        """
+        return UrlSigner(self.config['signed_url_secret'],
+                         self.config['signed_url_lifetime'],
+                         self.config['signed_url_bind_ip'])
+
+    def use_proxy_offload(self):
+        return self.config['reverse_proxy_enabled'] and self.config['proxy_offload'] in PROXY_OFFLOAD_METHODS
+
+    def build_url_signer(self):
+        if not self.config['sign_stream_urls']:
+            return None
+
+        return UrlSigner(self.config['signed_url_secret'],
+                         self.config['signed_url_lifetime'],
+                         self.config['signed_url_bind_ip'])
+
+    def update_resources(self):
+        """
+        Make the resources match the config, resources that already exist are updated in place.
+        """
+        self.file_resource.signer = self.url_signer
+        self.file_resource.trust_forwarded_for = self.trust_forwarded_for()
+
+        if self.use_proxy_offload():
+            self.resource.putChild(b'completed', OffloadFileResource(self.completed_signer,
+                                                                     trust_forwarded_for=True,
+                                                                     offload=self.config['proxy_offload'],
+                                                                     location=self.config['proxy_offload_location'],
+                                                                     root=self.config['proxy_offload_root']))
+        elif b'completed' in self.resource.children:
+            self.resource.delEntity(b'completed')
+
+        for name, resource_cls in self.remote_resources:
+            child = self.resource.children.get(name)
+            if not self.config['allow_remote']:
+                if child is not None:
+                    self.resource.delEntity(name)
+            elif child is None:
+                self.resource.putChild(name, resource_cls(username=self.config['remote_username'],
+                                                          password=self.config['remote_password'],
+                                                          client=self))
+            else:
+                child.set_credentials(self.config['remote_username'], self.config['remote_password'])
+
+    @defer.inlineCallbacks
+    def disable(self):
+        if not self._is_enabled:
+            defer.returnValue(None)
+
+        self._is_enabled = False
+
+        yield self.server_ready
+        if self.site is not None:
+            self.site.stopFactory()
+        self.torrent_handler.shutdown()
+        if self.thomas_http_output is not None:
+            self.thomas_http_output.stop()
+            self.thomas_http_output = None
+        yield self.torrent_fetcher.close()
+
+        yield self.stop_listening()
+        self.site = None
+        self.listen_address = None
+
     def update(self):
         pass
 
@@ -828,72 +2137,293 @@ class Core(CorePluginBase):
         plugin_manager = component.get("CorePluginManager")
         return 'WebUi' in plugin_manager.get_enabled_plugins()
 
+    def get_client_ip(self, request):
+        return get_client_ip(request, self.trust_forwarded_for())
+
+    def sign_stream_url(self, stream_url, client_ip=None):
+        if self.url_signer is None:
+            return stream_url
+
+        token = stream_url.lstrip('/').split('/')[1]
+        return '%s?%s' % (stream_url, urlencode(self.url_signer.sign(token, client_ip)))
+
     @export
     @defer.inlineCallbacks
     def set_config(self, config):
         self.previous_config = copy(self.config)
 
+        changed_keys = set(key for key in config.keys() if self.config.config.get(key) != config[key])
         for key in config.keys():
             self.config[key] = config[key]
         self.config.save()
 
-        yield self.disable()
-        self.enable()
+        if self._is_enabled:
+            yield self.apply_config(changed_keys)
+        else:
+            self.enable()
 
         if self.config['serve_method'] == 'standalone' and self.config['ssl_source'] == 'custom' and self.config['use_ssl']:
             if not self.check_ssl():
                 defer.returnValue(('error', 'ssl', 'SSL not enabled, make sure the private key and certificate exist and are accessible'))
 
+    @defer.inlineCallbacks
+    def apply_config(self, changed_keys):
+        """
+        Apply changed config keys to the running plugin without touching active streams.
+        Only changes to how the server listens rebind the listener.
+        """
+        if not changed_keys:
+            return
+
+        logger.info('Applying changed config keys: %s' % (', '.join(sorted(changed_keys)), ))
+
+        if changed_keys & SIGNING_CONFIG_KEYS:
+            self.url_signer = self.build_url_signer()
+            self.completed_signer = self.build_completed_signer()
+        self.update_resources()
+
+        self.torrent_handler.set_prioritization(self.config['download_only_streamed'] == False,
+                                                self.config['aggressive_prioritizing'])
+        self.torrent_handler.metadata_timeout = self.config['magnet_metadata_timeout']
+        self.torrent_handler.lookahead_bytes = self.config['lookahead_bytes']
+        self.torrent_handler.lookahead_seconds = self.config['lookahead_seconds']
+        self.torrent_handler.fanout_window = self.config['fanout_window']
+        self.torrent_handler.read_stall_timeout = self.config['read_stall_timeout']
+        self.torrent_handler.stall_tuning = self.get_stall_tuning()
+        self.torrent_handler.buffer_pool.max_bytes = self.config['buffer_memory_limit']
+        self.torrent_handler.scheduler.configured_capacity = self.config['scheduler_capacity']
+        self.torrent_handler.set_use_scheduler(self.config['use_scheduler'])
+        self.check_admission_control()
+        if self.config['persist_state']:
+            self.torrent_handler.set_state_path(os.path.join(configmanager.get_config_dir(), STATE_FILENAME))
+        else:
+            self.torrent_handler.set_state_path(None)
+
+        self.torrent_fetcher.max_entries = self.config['torrent_cache_max_entries']
+        self.torrent_fetcher.max_bytes = self.config['torrent_cache_max_bytes']
+        self.torrent_fetcher.max_age = self.config['torrent_cache_max_age']
+        self.torrent_fetcher.timeout = self.config['torrent_fetch_timeout']
+
+        yield self.server_ready
+        if changed_keys & LISTENER_CONFIG_KEYS:
+            logger.info('Listener config changed, rebinding')
+            yield self.stop_listening()
+            if self.site is not None:
+                self.start_listening()
+        else:
+            self.update_base_url()
+            if changed_keys & WORKER_CONFIG_KEYS and self.site is not None:
+                logger.info('Worker config changed, restarting workers')
+                yield self.stop_workers()
+                self.start_workers()
+
+        self.stream_flights.forget()
+
     @export
     def get_config(self):
         """Returns the config dictionary"""
         return self.config.config
 
-    @export
+    def add_torrent(self, infohash=None, url=None, filedump=None, label=None):
+        """
+        Make sure the torrent exist in Deluge, returns the infohash of the torrent.
+
+        Concurrent calls for the same torrent share the work.
+        """
+        if infohash:
+            key = ('infohash', infohash)
+        elif url:
+            key = ('url', url)
+        elif filedump:
+            key = ('filedump', hashlib.sha1(filedump).hexdigest())
+        else:
+            return defer.fail(StreamError('unable to find torrent, provide infohash, url or filedump'))
+
+        return self.add_torrent_flights.run(key, self._add_torrent, infohash, url, filedump, label)
+
     @defer.inlineCallbacks
-    def stream_torrent(self, infohash=None, url=None, filedump=None, filepath_or_index=None, includes_name=False, wait_for_end_pieces=False, label=None, as_inline=False):
-        logger.debug('Trying to stream infohash:%s, url:%s, filepath_or_index:%s' % (infohash, url, filepath_or_index))
+    def _add_torrent(self, infohash, url, filedump, label):
+        if url and is_magnet(url) and not filedump:
+            infohash = get_magnet_infohash(url)
+            if not infohash:
+                raise StreamError('invalid magnet uri')
+
+            if get_torrent(infohash) is None:
+                yield self.add_torrent_flights.run(('add', infohash), self._add_torrent_magnet, infohash, url, label)
+
+            defer.returnValue(infohash)
+
         torrent = get_torrent(infohash)
 
         if torrent is None:
             logger.info('Did not find torrent, must add it')
 
+            if not filedump and infohash:
+                filedump = self.torrent_fetcher.get_by_infohash(infohash)
+
             if not filedump and url:
-                filedump = yield client.getPage(url)
+                try:
+                    filedump = yield self.torrent_fetcher.fetch(url)
+                except FetchError as e:
+                    logger.warning('Failed to fetch torrent: %s' % (e, ))
+                    raise StreamError('failed to fetch torrent from url')
 
             if not filedump:
-                defer.returnValue({'status': 'error', 'message': 'unable to find torrent, provide infohash, url or filedump'})
+                raise StreamError('unable to find torrent, provide infohash, url or filedump')
+
+            try:
+                torrent_info = yield threads.deferToThread(parse_torrent, filedump)
+            except ValueError as e:
+                logger.warning('Failed to parse torrent: %s' % (e, ))
+                raise StreamError('invalid torrent')
 
-            torrent_info = lt.torrent_info(lt.bdecode(filedump))
             infohash = str(torrent_info.info_hash())
+            if url:
+                self.torrent_fetcher.remember_infohash(url, infohash)
 
-            core = component.get("Core")
-            try:
-                yield core.add_torrent_file('file.torrent', base64.b64encode(filedump), {'add_paused': True})
-                if label and 'Label' in component.get('CorePluginManager').get_enabled_plugins():
-                    label_plugin = component.get('CorePlugin.Label')
-                    if label not in label_plugin.get_labels():
-                        label_plugin.add(label)
+            yield self.add_torrent_flights.run(('add', infohash), self._add_torrent_file, infohash, torrent_info, filedump, label)
 
-                    try:
-                        label_plugin.set_torrent(infohash, label)
-                    except:
-                        logger.exception('Failed to set label')
-            except:
-                logger.exception('Failed to add torrent')
-                defer.returnValue({'status': 'error', 'message': 'failed to add torrent'})
+        defer.returnValue(infohash)
+
+    def _add_torrent_file(self, infohash, torrent_info, filedump, label):
+        if get_torrent(infohash) is not None:
+            logger.debug('Torrent %s was added while we prepared it' % (infohash, ))
+            return
+
+        torrent_manager = component.get("TorrentManager")
+        try:
+            # The already parsed torrent_info is handed over directly, passing the filedump
+            # would make Deluge parse it again so the torrent file is written afterwards.
+            if not torrent_manager.add(torrent_info=torrent_info, options={'add_paused': True}, filename='file.torrent'):
+                raise StreamError('failed to add torrent')
+        except:
+            logger.exception('Failed to add torrent')
+            raise StreamError('failed to add torrent')
+
+        self.write_torrent_file(infohash, filedump)
+        self._set_label(infohash, label)
+
+    def write_torrent_file(self, infohash, filedump):
+        """
+        Store the torrent file where Deluge keeps the torrent files of its torrents,
+        Torrent.write_torrentfile takes different arguments depending on the Deluge version.
+        """
+        torrent_path = os.path.join(configmanager.get_config_dir(), 'state', '%s.torrent' % (infohash, ))
+        try:
+            with open(torrent_path + '.tmp', 'wb') as f:
+                f.write(filedump)
+            os.rename(torrent_path + '.tmp', torrent_path)
+        except (IOError, OSError):
+            logger.exception('Failed to write the torrent file of %s' % (infohash, ))
+
+    def _add_torrent_magnet(self, infohash, uri, label):
+        if get_torrent(infohash) is not None:
+            logger.debug('Torrent %s was added while we prepared it' % (infohash, ))
+            return
+
+        torrent_manager = component.get("TorrentManager")
+        try:
+            # Magnets are added unpaused so the metadata is fetched right away
+            if not torrent_manager.add(magnet=uri, options={'add_paused': False}):
+                raise StreamError('failed to add magnet')
 
+            self._set_label(infohash, label)
+        except:
+            logger.exception('Failed to add magnet')
+            raise StreamError('failed to add magnet')
+
+    def _set_label(self, infohash, label):
+        if not label or 'Label' not in component.get('CorePluginManager').get_enabled_plugins():
+            return
+
+        try:
+            label_plugin = component.get('CorePlugin.Label')
+            if label not in label_plugin.get_labels():
+                label_plugin.add(label)
+            label_plugin.set_torrent(infohash, label)
+        except:
+            logger.exception('Failed to set label')
+
+    @defer.inlineCallbacks
+    def admit_stream(self, infohash):
+        """
+        Check if there is bandwidth enough to start a new stream without
+        pushing the existing streams below real-time.
+
+        Streams from torrents already being streamed or already downloaded are always admitted.
+        If configured, the request waits in line until there is room or the queue timeout is hit.
+        """
+        if not self.config['admission_control']:
+            defer.returnValue(True)
+
+        if infohash in self.torrent_handler.torrents and self.torrent_handler.torrents[infohash].readers:
+            defer.returnValue(True)
+
+        if get_torrent(infohash).get_status(['progress'])['progress'] == 100.0:
+            defer.returnValue(True)
+
+        admitted = yield self.torrent_handler.scheduler.admit(infohash, self.config['admission_default_bitrate'],
+                                                              self.config['admission_min_headroom'],
+                                                              self.config['admission_queue_timeout'])
+        defer.returnValue(admitted)
+
+    def prepare_stream(self, infohash, filepath_or_index=None, wait_for_end_pieces=False, as_inline=False, client_ip=None):
+        """
+        Stream a path from a torrent already in Deluge, returns a stream_torrent response.
+
+        Concurrent calls with the same arguments share the preparation and
+        successful responses are reused for a short while.
+        """
+        if self.url_signer is None or not self.url_signer.bind_ip:
+            key_client_ip = None
+        else:
+            key_client_ip = client_ip
+
+        key = (infohash, filepath_or_index, bool(wait_for_end_pieces), bool(as_inline), key_client_ip)
+        return self.stream_flights.run(key, self._prepare_stream, infohash, filepath_or_index,
+                                       wait_for_end_pieces=wait_for_end_pieces, as_inline=as_inline, client_ip=client_ip)
+
+    @defer.inlineCallbacks
+    def _prepare_stream(self, infohash, filepath_or_index=None, wait_for_end_pieces=False, as_inline=False, client_ip=None):
         if filepath_or_index is None:
             fn = ''
         elif isinstance(filepath_or_index, int):
-            status = torrent.get_status(['files'])
-            fn = status['files'][filepath_or_index]['path']
+            try:
+                fn = yield self.get_file_path(infohash, filepath_or_index)
+            except StreamError as e:
+                defer.returnValue({'status': 'error', 'message': str(e)})
         else:
             fn = filepath_or_index
 
+        admitted = yield self.admit_stream(infohash)
+        if not admitted:
+            logger.info('Not enough bandwidth to start streaming %s from %s' % (fn, infohash))
+            defer.returnValue({
+                'status': 'busy',
+                'message': 'not enough bandwidth for another stream',
+                'retry_after': self.config['admission_retry_after'],
+            })
+
         try:
             stream_or_item = yield defer.maybeDeferred(self.torrent_handler.stream, infohash, fn, wait_for_end_pieces=wait_for_end_pieces)
-            stream_url = self.thomas_http_output.serve_item(stream_or_item, as_inline=as_inline)
+            yield self.server_ready
+
+            completed_path = None
+            if self.use_proxy_offload() or self.worker_pool is not None:
+                completed_path = self.torrent_handler.get_completed_path(infohash, stream_or_item)
+
+            if completed_path and self.use_proxy_offload():
+                url = '%s/streaming%s' % (self.base_url,
+                                          create_completed_url(self.completed_signer, completed_path, client_ip))
+            elif completed_path:
+                url = '%s/streaming%s' % (self.get_worker_base_url(),
+                                          create_completed_url(self.completed_signer, completed_path, client_ip))
+            else:
+                stream_url = self.get_http_output().serve_item(stream_or_item, as_inline=as_inline)
+                stream_url = self.sign_stream_url(stream_url, client_ip)
+                url = '%s/streaming/%s' % (self.base_url, stream_url.lstrip('/'))
+        except StreamError as e:
+            defer.returnValue({'status': 'error', 'message': str(e)})
         except:
             logger.exception('Failed to stream torrent')
             defer.returnValue({'status': 'error', 'message': 'failed to stream torrent'})
@@ -903,5 +2433,177 @@ class Core(CorePluginBase):
             'filename': stream_or_item.id,
             'use_stream_urls': self.config['use_stream_urls'],
             'auto_open_stream_urls': self.config['auto_open_stream_urls'],
-            'url': '%s/streaming/%s' % (self.base_url, stream_url.lstrip('/'))
+            'url': url,
+        })
+
+    @defer.inlineCallbacks
+    def get_file_path(self, infohash, index):
+        """
+        Path of the file at index in the torrent, waits for the metadata of a magnet.
+        """
+        if not get_torrent(infohash).handle.has_metadata():
+            try:
+                yield self.torrent_handler.wait_for_metadata(infohash)
+            except defer.TimeoutError:
+                raise StreamError('timeout while waiting for torrent metadata')
+
+        files = get_torrent(infohash).get_status(['files'])['files']
+        if not 0 <= index < len(files):
+            raise StreamError('file index %s out of range' % (index, ))
+        defer.returnValue(files[index]['path'])
+
+    @export
+    @defer.inlineCallbacks
+    def stream_torrent(self, infohash=None, url=None, filedump=None, filepath_or_index=None, includes_name=False, wait_for_end_pieces=False, label=None, as_inline=False, client_ip=None):
+        logger.debug('Trying to stream infohash:%s, url:%s, filepath_or_index:%s' % (infohash, url, filepath_or_index))
+
+        try:
+            infohash = yield self.add_torrent(infohash=infohash, url=url, filedump=filedump, label=label)
+        except StreamError as e:
+            defer.returnValue({'status': 'error', 'message': str(e)})
+
+        result = yield self.prepare_stream(infohash, filepath_or_index, wait_for_end_pieces=wait_for_end_pieces, as_inline=as_inline, client_ip=client_ip)
+        defer.returnValue(result)
+
+    def stream_batch(self, entries, wait_for_end_pieces=False, as_inline=False, client_ip=None):
+        """
+        Prepare many streams concurrently, returns a list with a Deferred for each entry.
+
+        Entries pointing to the same torrent share the lookup and add of that torrent.
+        Each Deferred fires with a stream_torrent response that also contains the index of the entry.
+        """
+        groups = {}
+        results = []
+        for index, entry in enumerate(entries):
+            if entry.get('infohash'):
+                group_key = ('infohash', entry['infohash'])
+            elif entry.get('url'):
+                group_key = ('url', entry['url'])
+            elif entry.get('filedump'):
+                group_key = ('filedump', hashlib.sha1(entry['filedump']).hexdigest())
+            else:
+                group_key = ('invalid', index)
+
+            d = defer.Deferred()
+            groups.setdefault(group_key, []).append((index, entry, d))
+            results.append(d)
+
+        for group in groups.values():
+            self._stream_batch_group(group, wait_for_end_pieces, as_inline, client_ip)
+
+        return results
+
+    @defer.inlineCallbacks
+    def _stream_batch_group(self, group, wait_for_end_pieces, as_inline, client_ip):
+        first_entry = group[0][1]
+        try:
+            infohash = yield self.add_torrent(infohash=first_entry.get('infohash'), url=first_entry.get('url'),
+                                              filedump=first_entry.get('filedump'), label=first_entry.get('label'))
+        except StreamError as e:
+            for index, entry, d in group:
+                d.callback({'status': 'error', 'message': str(e), 'index': index})
+            defer.returnValue(None)
+        except:
+            logger.exception('Failed to add torrent for batch')
+            for index, entry, d in group:
+                d.callback({'status': 'error', 'message': 'failed to add torrent', 'index': index})
+            defer.returnValue(None)
+
+        def add_index(result, index):
+            result['index'] = index
+            return result
+
+        def stream_failed(failure, index):
+            if failure.check(StreamError):
+                message = failure.getErrorMessage()
+            else:
+                logger.error('Failed to prepare batch entry %s: %s' % (index, failure.getTraceback()))
+                message = 'failed to prepare stream'
+            return {'status': 'error', 'message': message, 'index': index}
+
+        for index, entry, d in group:
+            stream_d = defer.maybeDeferred(self.prepare_stream, infohash, entry.get('path'),
+                                           wait_for_end_pieces=entry.get('wait_for_end_pieces', wait_for_end_pieces),
+                                           as_inline=as_inline, client_ip=client_ip)
+            stream_d.addCallbacks(add_index, stream_failed, callbackArgs=(index, ), errbackArgs=(index, ))
+            stream_d.chainDeferred(d)
+
+    def get_prefetch_size(self, bytes_or_seconds):
+        """
+        Converts a prefetch size to bytes, strings ending with s are seconds of playback.
+        """
+        if bytes_or_seconds is None:
+            return self.config['prefetch_default_size']
+
+        if isinstance(bytes_or_seconds, (int, float)):
+            return int(bytes_or_seconds)
+
+        bytes_or_seconds = bytes_or_seconds.strip().lower()
+        if bytes_or_seconds.endswith('s'):
+            return int(float(bytes_or_seconds[:-1]) * self.config['prefetch_bitrate'])
+        return int(bytes_or_seconds)
+
+    @export
+    @defer.inlineCallbacks
+    def prefetch(self, infohash, path=None, bytes_or_seconds=None):
+        """
+        Start downloading the beginning of a file that will probably be streamed soon.
+
+        bytes_or_seconds is either a number of bytes or a string like "30s" for seconds of playback.
+        The prefetch is dropped if no one starts streaming the file before it times out.
+        """
+        if get_torrent(infohash) is None:
+            defer.returnValue({'status': 'error', 'message': 'unable to find torrent'})
+
+        try:
+            size = self.get_prefetch_size(bytes_or_seconds)
+        except ValueError:
+            defer.returnValue({'status': 'error', 'message': 'invalid prefetch size'})
+
+        try:
+            path, size = yield self.torrent_handler.prefetch(infohash, path or '', size)
+        except StreamError as e:
+            defer.returnValue({'status': 'error', 'message': str(e)})
+        except:
+            logger.exception('Failed to prefetch')
+            defer.returnValue({'status': 'error', 'message': 'failed to prefetch'})
+
+        defer.returnValue({
+            'status': 'success',
+            'path': path,
+            'size': size,
         })
+
+    @export
+    def set_stream_weight(self, infohash, weight):
+        """
+        Set how big a share of the bandwidth a streamed torrent gets compared to other streamed torrents.
+        """
+        if get_torrent(infohash) is None:
+            return False
+
+        self.torrent_handler.get_torrent(infohash).weight = max(float(weight), 0.01)
+        return True
+
+    @export
+    def get_stats(self):
+        """
+        Returns statistics about the active streams.
+        """
+        return {
+            'scheduler': self.torrent_handler.scheduler.get_status(),
+            'buffers': self.torrent_handler.buffer_pool.get_status(),
+            'fanout': self.torrent_handler.get_fanout_status(),
+            'readers': self.torrent_handler.get_reader_status(),
+            'stalls': self.torrent_handler.get_stall_status(),
+        }
+
+    @export
+    def stream_torrents(self, entries, wait_for_end_pieces=False, as_inline=False):
+        """
+        Batch version of stream_torrent.
+
+        entries is a list of dicts with the keys infohash, url, filedump, label and path.
+        Returns a list of stream_torrent responses in the same order as the entries.
+        """
+        return defer.gatherResults(self.stream_batch(entries, wait_for_end_pieces=wait_for_end_pieces, as_inline=as_inline))
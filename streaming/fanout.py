@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PENDING_READ_TIMEOUT = 30
+
+
+def get_playheads(readers):
+    playheads = {}
+    for reader in readers:
+        try:
+            playheads[reader] = reader.current_piece[0]
+        except TypeError:  # reader has not seeked yet
+            pass
+    return playheads
+
+
+def get_attached_readers(playheads, window):
+    """
+    Readers with another reader less than window pieces away, they share piece reads.
+    """
+    attached = set()
+    ordered = sorted(playheads.items(), key=lambda item: item[1])
+    for (reader, playhead), (next_reader, next_playhead) in zip(ordered, ordered[1:]):
+        if next_playhead - playhead <= window:
+            attached.add(reader)
+            attached.add(next_reader)
+    return attached
+
+
+class PieceFanout(object):
+    """
+    Lets readers of a torrent that play close to each other share piece reads.
+
+    A piece is only read once while a read of it is in flight. Pieces wanted by more than
+    one reader less than window pieces behind them are kept until those readers have
+    passed them, readers that drift further away stop sharing automatically.
+
+    Kept pieces count towards the buffer pool like the pieces buffered by readers, the pool
+    can drop them with evict_piece.
+    """
+    current_piece = None  # no playhead of its own in the buffer pool
+
+    def __init__(self, infohash, buffer_pool):
+        self.infohash = infohash
+        self.buffer_pool = buffer_pool
+        self.lock = threading.Lock()
+        self.pieces = {}
+        self.pending_reads = {}
+        self.reads = 0
+        self.shared_reads = 0
+
+    def request(self, piece):
+        """
+        Returns (data, read_needed), data is set when the piece is kept already.
+        """
+        with self.lock:
+            if piece in self.pieces:
+                self.shared_reads += 1
+                return self.pieces[piece], False
+
+            if self.pending_reads.get(piece, 0) + PENDING_READ_TIMEOUT > time.time():
+                self.shared_reads += 1
+                return None, False
+
+            self.pending_reads[piece] = time.time()
+            self.reads += 1
+            return None, True
+
+    def piece_read(self, piece, data, playheads, window):
+        kept = False
+        with self.lock:
+            self.pending_reads.pop(piece, None)
+            if window and len([playhead for playhead in playheads.values() if playhead <= piece <= playhead + window]) > 1:
+                self.pieces[piece] = data
+                kept = True
+            dropped = self._trim(playheads, window)
+
+        self.remove_from_pool(dropped)
+        if kept:  # the pool is only called outside the lock, it may call evict_piece
+            self.buffer_pool.add(self, piece, len(data))
+
+    def trim(self, playheads, window):
+        with self.lock:
+            dropped = self._trim(playheads, window)
+        self.remove_from_pool(dropped)
+
+    def _trim(self, playheads, window):
+        dropped = []
+        for piece in list(self.pieces.keys()):
+            if not window or not any(playhead <= piece <= playhead + window for playhead in playheads.values()):
+                del self.pieces[piece]
+                dropped.append(piece)
+        return dropped
+
+    def remove_from_pool(self, pieces):
+        for piece in pieces:
+            self.buffer_pool.remove(self, piece)
+
+    def evict_piece(self, piece):
+        with self.lock:
+            self.pieces.pop(piece, None)
+
+    def clear(self):
+        with self.lock:
+            self.pieces = {}
+            self.pending_reads = {}
+        self.buffer_pool.remove_reader(self)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'kept_pieces': len(self.pieces),
+                'kept_bytes': sum(len(data) for data in self.pieces.values()),
+                'reads': self.reads,
+                'shared_reads': self.shared_reads,
+            }
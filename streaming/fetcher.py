@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from deluge.bencode import BTFailure, bdecode
+
+from twisted.internet import defer, reactor, threads
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+MAX_PERSISTENT_CONNECTIONS_PER_HOST = 4
+CACHED_CONNECTION_TIMEOUT = 120
+
+
+class FetchError(Exception):
+    pass
+
+
+def is_torrent(body):
+    try:
+        metainfo = bdecode(body)
+    except BTFailure:
+        return False
+    return isinstance(metainfo, dict) and isinstance(metainfo.get(b'info'), dict)
+
+
+class TorrentFetcher(object):
+    """
+    Fetches torrent files over HTTP with a persistent connection pool and keeps
+    a bounded on-disk cache of the bodies keyed by URL and infohash.
+
+    Cached bodies younger than max_age are returned without touching the network,
+    older ones are revalidated with ETag / Last-Modified.
+    Only bodies that decode to a torrent are cached, anything else counts as a failed fetch.
+    """
+    def __init__(self, cache_path, max_entries=100, max_bytes=50 * 1024 * 1024, max_age=3600, timeout=30):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.pool = None
+        self.agent = None
+
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+        self.index = self.load_index()
+
+    def load_index(self):
+        index_path = os.path.join(self.cache_path, INDEX_FILENAME)
+        if not os.path.isfile(index_path):
+            return {}
+
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            logger.warning('Failed to load torrent cache index, starting with an empty cache')
+            return {}
+
+    def save_index(self):
+        index_path = os.path.join(self.cache_path, INDEX_FILENAME)
+        try:
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.rename(index_path + '.tmp', index_path)
+        except (IOError, OSError):
+            logger.exception('Failed to save torrent cache index')
+
+    def get_agent(self):
+        """
+        The HTTP client is set up when the first torrent is fetched.
+        """
+        if self.agent is None:
+            from twisted.web import client
+
+            self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+            self.pool.maxPersistentPerHost = MAX_PERSISTENT_CONNECTIONS_PER_HOST
+            self.pool.cachedConnectionTimeout = CACHED_CONNECTION_TIMEOUT
+            self.agent = client.RedirectAgent(client.Agent(reactor, pool=self.pool, connectTimeout=self.timeout))
+
+        return self.agent
+
+    def get_body_path(self, url):
+        return os.path.join(self.cache_path, '%s.torrent' % (hashlib.sha1(url.encode('utf-8')).hexdigest(), ))
+
+    def read_body(self, url):
+        try:
+            with open(self.get_body_path(url), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def store(self, url, body, etag=None, last_modified=None):
+        with open(self.get_body_path(url), 'wb') as f:
+            f.write(body)
+
+        entry = self.index.get(url, {})
+        entry.update({
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': len(body),
+            'fetched': time.time(),
+            'used': time.time(),
+        })
+        self.index[url] = entry
+        self.evict()
+        self.save_index()
+
+    def evict(self):
+        entries = sorted(self.index.items(), key=lambda x: x[1]['used'])
+        total_bytes = sum(entry['size'] for _, entry in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            url, entry = entries.pop(0)
+            logger.debug('Evicting %s from torrent cache' % (url, ))
+            total_bytes -= entry['size']
+            del self.index[url]
+            try:
+                os.remove(self.get_body_path(url))
+            except OSError:
+                pass
+
+    def remember_infohash(self, url, infohash):
+        if url in self.index and self.index[url].get('infohash') != infohash:
+            self.index[url]['infohash'] = infohash
+            self.save_index()
+
+    def get_by_infohash(self, infohash):
+        """
+        Returns a cached torrent body with the given infohash or None.
+        """
+        for url, entry in self.index.items():
+            if entry.get('infohash') == infohash:
+                body = self.read_body(url)
+                if body is not None:
+                    entry['used'] = time.time()
+                    return body
+        return None
+
+    @defer.inlineCallbacks
+    def fetch(self, url):
+        entry = self.index.get(url)
+        body = entry and self.read_body(url)
+
+        if body is not None:
+            entry['used'] = time.time()
+            if entry['fetched'] + self.max_age > time.time():
+                logger.debug('Using cached torrent for %s' % (url, ))
+                defer.returnValue(body)
+
+        from twisted.web import client
+        from twisted.web.http_headers import Headers
+
+        headers = Headers()
+        if body is not None:
+            if entry.get('etag'):
+                headers.addRawHeader(b'If-None-Match', entry['etag'].encode('utf-8'))
+            if entry.get('last_modified'):
+                headers.addRawHeader(b'If-Modified-Since', entry['last_modified'].encode('utf-8'))
+
+        try:
+            d = self.get_agent().request(b'GET', url.encode('utf-8'), headers)
+            d.addTimeout(self.timeout, reactor)
+            response = yield d
+
+            if response.code == 304 and body is not None:
+                logger.debug('Cached torrent for %s is still valid' % (url, ))
+                yield client.readBody(response)
+                entry['fetched'] = time.time()
+                self.save_index()
+                defer.returnValue(body)
+
+            d = client.readBody(response)
+            d.addTimeout(self.timeout, reactor)
+            new_body = yield d
+        except (defer.TimeoutError, defer.CancelledError):
+            new_body = None
+            error_message = 'timeout while fetching %s' % (url, )
+        except Exception as e:
+            new_body = None
+            error_message = 'failed to fetch %s: %s' % (url, e)
+        else:
+            error_message = None
+            if response.code != 200:
+                new_body = None
+                error_message = 'got status code %s while fetching %s' % (response.code, url)
+            elif not (yield threads.deferToThread(is_torrent, new_body)):
+                new_body = None
+                error_message = 'response from %s is not a torrent' % (url, )
+
+        if new_body is None:
+            if body is not None:
+                logger.warning('%s, using stale cached torrent' % (error_message, ))
+                defer.returnValue(body)
+            raise FetchError(error_message)
+
+        etag = response.headers.getRawHeaders(b'etag', [None])[0]
+        last_modified = response.headers.getRawHeaders(b'last-modified', [None])[0]
+        self.store(url, new_body,
+                   etag=etag and etag.decode('utf-8'),
+                   last_modified=last_modified and last_modified.decode('utf-8'))
+
+        defer.returnValue(new_body)
+
+    def close(self):
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
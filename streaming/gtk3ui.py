@@ -125,6 +125,8 @@ class Gtk3UI(Gtk3PluginBase):
         log.debug("applying prefs for Streaming")
 
         serve_method = 'standalone'
+        if getattr(self, 'serve_method', None) == 'unix':  # only configurable in streaming.conf
+            serve_method = 'unix'
         # if self.builder.get_object("input_serve_standalone").get_active():
         #     serve_method = 'standalone'
         # elif self.builder.get_object("input_serve_webui").get_active():
@@ -171,6 +173,7 @@ class Gtk3UI(Gtk3PluginBase):
 
     def cb_get_config(self, config):
         """callback for on show_prefs"""
+        self.serve_method = config["serve_method"]
         self.builder.get_object("input_ip").set_text(config["ip"])
         self.builder.get_object("input_port").set_text(str(config["port"]))
         self.builder.get_object("input_use_stream_urls").set_active(config["use_stream_urls"])
@@ -125,6 +125,8 @@ class GtkUI(GtkPluginBase):
         log.debug("applying prefs for Streaming")
 
         serve_method = 'standalone'
+        if getattr(self, 'serve_method', None) == 'unix':  # only configurable in streaming.conf
+            serve_method = 'unix'
         # if self.glade.get_widget("input_serve_standalone").get_active():
         #     serve_method = 'standalone'
         # elif self.glade.get_widget("input_serve_webui").get_active():
@@ -170,6 +172,7 @@ class GtkUI(GtkPluginBase):
 
     def cb_get_config(self, config):
         "callback for on show_prefs"
+        self.serve_method = config["serve_method"]
         self.glade.get_widget("input_ip").set_text(config["ip"])
         self.glade.get_widget("input_port").set_text(str(config["port"]))
         self.glade.get_widget("input_use_stream_urls").set_active(config["use_stream_urls"])
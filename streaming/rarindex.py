@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import re
+import struct
+
+logger = logging.getLogger(__name__)
+
+RAR4_SIGNATURE = b'Rar!\x1a\x07\x00'
+RAR5_SIGNATURE = b'Rar!\x1a\x07\x01\x00'
+RAR4_FILE_HEADER = 0x74
+RAR4_LONG_BLOCK = 0x8000
+RAR4_LARGE_FILE = 0x100
+RAR5_FILE_HEADER = 2
+RAR5_HAS_EXTRA_AREA = 0x1
+RAR5_HAS_DATA_AREA = 0x2
+HEADER_READ_SIZE = 64 * 1024
+
+RAR_VOLUME_PATTERN = re.compile(r'\.(rar|r\d\d|\d\d\d)$', re.IGNORECASE)
+
+
+class RarIndexError(Exception):
+    pass
+
+
+def is_rar_volume(path):
+    return bool(RAR_VOLUME_PATTERN.search(path))
+
+
+def read_vint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise RarIndexError('truncated header')
+        byte = ord(data[pos:pos + 1])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def parse_rar4_volume(data):
+    pos = len(RAR4_SIGNATURE)
+    while pos + 7 <= len(data):
+        _, head_type, head_flags, head_size = struct.unpack('<HBHH', data[pos:pos + 7])
+        if head_size < 7:
+            raise RarIndexError('invalid header size')
+
+        add_size = 0
+        if head_flags & RAR4_LONG_BLOCK:
+            if pos + 11 > len(data):
+                break
+            add_size = struct.unpack('<I', data[pos + 7:pos + 11])[0]
+
+        if head_type == RAR4_FILE_HEADER:
+            if pos + 36 > len(data):
+                break
+            pack_size = add_size
+            if head_flags & RAR4_LARGE_FILE:
+                pack_size += struct.unpack('<I', data[pos + 32:pos + 36])[0] << 32
+            return pos + head_size, pack_size
+
+        pos += head_size + add_size
+
+    raise RarIndexError('no file header found')
+
+
+def parse_rar5_volume(data):
+    pos = len(RAR5_SIGNATURE)
+    while pos + 4 < len(data):
+        header_size, header_start = read_vint(data, pos + 4)
+        header_type, field_pos = read_vint(data, header_start)
+        header_flags, field_pos = read_vint(data, field_pos)
+        if header_flags & RAR5_HAS_EXTRA_AREA:
+            _, field_pos = read_vint(data, field_pos)
+
+        data_size = 0
+        if header_flags & RAR5_HAS_DATA_AREA:
+            data_size, field_pos = read_vint(data, field_pos)
+
+        data_offset = header_start + header_size
+        if header_type == RAR5_FILE_HEADER:
+            return data_offset, data_size
+
+        pos = data_offset + data_size
+
+    raise RarIndexError('no file header found')
+
+
+def parse_volume(data):
+    """
+    Find where the packed data of the file stored in a rar volume starts and how long it is.
+    data must be the head of the volume.
+    """
+    if data.startswith(RAR5_SIGNATURE):
+        return parse_rar5_volume(data)
+    elif data.startswith(RAR4_SIGNATURE):
+        return parse_rar4_volume(data)
+    raise RarIndexError('not a rar volume')
+
+
+def read_volume(path):
+    with open(path, 'rb') as volume_file:
+        return parse_volume(volume_file.read(HEADER_READ_SIZE))
+
+
+class RarIndex(object):
+    """
+    Maps the packed file spread over a set of rar volumes to byte ranges in each volume.
+    Volumes are filled in as their heads are downloaded.
+    """
+    def __init__(self, paths, volumes=None):
+        self.paths = paths
+        self.volumes = volumes or {}
+
+    def add_volume(self, path, data_offset, data_size):
+        self.volumes[path] = {'data_offset': data_offset, 'data_size': data_size}
+
+    def is_complete(self):
+        return all(path in self.volumes for path in self.paths)
+
+    def get_next_path(self, path):
+        i = self.paths.index(path) + 1
+        if i < len(self.paths):
+            return self.paths[i]
+        return None
+
+    def get_ranges(self, offset, size):
+        """
+        Returns (path, start, end) in volume file bytes covering size bytes from offset
+        of the packed file, only usable when the index is complete.
+        """
+        ranges = []
+        logical_start = 0
+        for path in self.paths:
+            volume = self.volumes[path]
+            logical_end = logical_start + volume['data_size']
+            if offset < logical_end and offset + size > logical_start:
+                start = max(offset, logical_start) - logical_start
+                end = min(offset + size, logical_end) - logical_start
+                ranges.append((path, volume['data_offset'] + start, volume['data_offset'] + end))
+            logical_start = logical_end
+        return ranges
+
+    def serialize(self):
+        return {'paths': self.paths, 'volumes': self.volumes}
+
+
+class RarIndexCache(object):
+    """
+    Keeps the rar indexes of each torrent on disk so the volume layout is only found once.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+    def get_index_path(self, infohash):
+        return os.path.join(self.cache_path, '%s.json' % (infohash, ))
+
+    def load(self, infohash, paths):
+        try:
+            with open(self.get_index_path(infohash), 'r') as f:
+                indexes = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        index = indexes.get(','.join(paths))
+        if index is None:
+            return None
+        return RarIndex(index['paths'], index['volumes'])
+
+    def save(self, infohash, index):
+        index_path = self.get_index_path(infohash)
+        try:
+            with open(index_path, 'r') as f:
+                indexes = json.load(f)
+        except (IOError, ValueError):
+            indexes = {}
+
+        indexes[','.join(index.paths)] = index.serialize()
+        try:
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(indexes, f)
+            os.rename(index_path + '.tmp', index_path)
+        except (IOError, OSError):
+            logger.exception('Failed to save rar index for %s' % (infohash, ))
@@ -0,0 +1,251 @@
+import logging
+import time
+
+from deluge import component
+
+from twisted.internet import defer, reactor, task
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_INTERVAL = 1
+CAPACITY_DECAY = 0.98
+STARVED_WAIT_TIME = 2
+STARVED_RATE_RATIO = 0.9
+LIMIT_HEADROOM = 1.1
+MIN_DOWNLOAD_LIMIT = 16 * 1024
+BOOSTED_TORRENT_PRIORITY = 255
+NORMAL_TORRENT_PRIORITY = 1
+RESERVATION_TIMEOUT = 60
+
+
+def allocate_bandwidth(capacity, demands, weights):
+    """
+    Weighted max-min fair allocation of capacity between demands.
+
+    Nobody gets more than they ask for and what is left over by the
+    satisfied demands is shared by weight between the rest.
+    """
+    allocations = dict((key, 0) for key in demands)
+    remaining = set(key for key, demand in demands.items() if demand > 0)
+    left = capacity
+
+    while remaining and left > 0:
+        total_weight = sum(weights[key] for key in remaining)
+        share = float(left) / total_weight
+
+        satisfied = [key for key in remaining if demands[key] - allocations[key] <= share * weights[key]]
+        if not satisfied:
+            for key in remaining:
+                allocations[key] += share * weights[key]
+            break
+
+        for key in satisfied:
+            left -= demands[key] - allocations[key]
+            allocations[key] = demands[key]
+            remaining.remove(key)
+
+    return allocations
+
+
+class StreamScheduler(object):
+    """
+    Shares the download capacity between all streamed torrents.
+
+    Every tick the demand of each torrent is estimated from the bitrate of its readers
+    and the capacity is split with a weighted max-min fair allocation.
+    The allocation decides the deadlines set on the upcoming pieces of each reader and,
+    when there is not enough capacity, overserved torrents are limited so starved streams can catch up.
+
+    Admitted streams reserve their expected bitrate until their readers are measured, so a burst
+    of new streams cannot all be admitted into the same room. Streams waiting for room are admitted in order.
+    """
+    def __init__(self, torrent_handler, configured_capacity=0):
+        self.torrent_handler = torrent_handler
+        self.configured_capacity = configured_capacity
+        self.capacity = 0
+        self.limited_torrents = set()
+        self.status = []
+        self.reservations = {}
+        self.admission_queue = []
+
+        self.looping_call = task.LoopingCall(self.tick)
+
+    def start(self):
+        self.looping_call.start(SCHEDULER_INTERVAL)
+
+    def stop(self):
+        if self.looping_call.running:
+            self.looping_call.stop()
+
+        for torrent in list(self.limited_torrents):
+            self.remove_limit(torrent)
+
+        for waiter in list(self.admission_queue):
+            self.reject_waiter(waiter)
+
+    def get_session_download_rate(self):
+        try:
+            return component.get("Core").get_session_status(['payload_download_rate'])['payload_download_rate']
+        except (KeyError, AttributeError):
+            return sum(torrent.torrent.status.download_payload_rate for torrent in self.torrent_handler.torrents.values())
+
+    def update_capacity(self):
+        if self.configured_capacity:
+            self.capacity = self.configured_capacity
+        else:
+            self.capacity = max(self.get_session_download_rate(), self.capacity * CAPACITY_DECAY)
+        return self.capacity
+
+    def remove_limit(self, torrent):
+        self.limited_torrents.discard(torrent)
+        try:
+            max_download_speed = torrent.torrent.options['max_download_speed']
+            if max_download_speed > 0:
+                torrent.torrent.handle.set_download_limit(int(max_download_speed * 1024))
+            else:
+                torrent.torrent.handle.set_download_limit(-1)
+            torrent.torrent.handle.set_priority(NORMAL_TORRENT_PRIORITY)
+        except RuntimeError:
+            logger.warning('Failed to remove download limit from %s' % (torrent.infohash, ))
+
+    def tick(self):
+        try:
+            self._tick()
+        except:
+            logger.exception('Failed to run stream scheduler')
+
+    def _tick(self):
+        capacity = self.update_capacity()
+
+        streams = {}
+        for infohash, torrent in self.torrent_handler.torrents.items():
+            readers = list(torrent.readers.keys())
+            if not readers:
+                continue
+
+            streams[infohash] = {
+                'torrent': torrent,
+                'demand': sum(getattr(reader, 'get_bitrate', lambda: 0)() for reader in readers),
+                'waiting_time': max(getattr(reader, 'get_waiting_time', lambda: 0)() for reader in readers),
+                'rate': torrent.get_status(['download_payload_rate'])['download_payload_rate'],
+                'readers': len(readers),
+                'missing_pieces': torrent.has_missing_upcoming_pieces(),
+            }
+
+        for torrent in list(self.limited_torrents):
+            if torrent.infohash not in streams:
+                self.remove_limit(torrent)
+
+        now = time.time()
+        for infohash, (bitrate, expires) in list(self.reservations.items()):
+            if expires < now or (infohash in streams and streams[infohash]['demand'] > 0):
+                del self.reservations[infohash]
+
+        demands = dict((infohash, stream['demand']) for infohash, stream in streams.items())
+        weights = dict((infohash, stream['torrent'].weight) for infohash, stream in streams.items())
+        allocations = allocate_bandwidth(capacity, demands, weights)
+
+        for infohash, stream in streams.items():
+            stream['allocation'] = allocations[infohash]
+            # the download rate is only a sign of starvation while the readers still need pieces,
+            # a finished or well buffered stream downloads nothing
+            stream['starved'] = stream['waiting_time'] > STARVED_WAIT_TIME or \
+                (stream['missing_pieces'] and stream['demand'] > 0 and stream['rate'] < stream['demand'] * STARVED_RATE_RATIO)
+
+        contention = sum(demands.values()) > capacity or any(stream['starved'] for stream in streams.values())
+        for infohash, stream in streams.items():
+            torrent = stream['torrent']
+            torrent.apply_allocation(stream['allocation'])
+
+            if stream['starved']:
+                torrent.torrent.handle.set_priority(BOOSTED_TORRENT_PRIORITY)
+            else:
+                torrent.torrent.handle.set_priority(NORMAL_TORRENT_PRIORITY)
+
+            overserved = stream['allocation'] > 0 and stream['rate'] > stream['allocation'] * LIMIT_HEADROOM
+            if contention and overserved and not stream['starved']:
+                limit = max(int(stream['allocation'] * LIMIT_HEADROOM), MIN_DOWNLOAD_LIMIT)
+                logger.debug('Limiting %s to %s bytes/s to give starved streams room' % (infohash, limit))
+                torrent.torrent.handle.set_download_limit(limit)
+                self.limited_torrents.add(torrent)
+            elif torrent in self.limited_torrents:
+                self.remove_limit(torrent)
+
+        self.status = [{
+            'infohash': infohash,
+            'readers': stream['readers'],
+            'weight': stream['torrent'].weight,
+            'bitrate': stream['demand'],
+            'download_rate': stream['rate'],
+            'allocation': int(stream['allocation']),
+            'starved': stream['starved'],
+            'limited': stream['torrent'] in self.limited_torrents,
+        } for infohash, stream in streams.items()]
+
+        self.process_admission_queue()
+
+    def can_admit(self, bitrate, min_headroom=0.0):
+        """
+        Check if a new stream with bitrate fits next to the active and reserved streams
+        while keeping min_headroom of the capacity free.
+
+        Without active or reserved streams there is always room, the measured capacity
+        decays while idle and would otherwise never grow back.
+        """
+        if not self.capacity or (not self.status and not self.reservations):
+            return True
+
+        if any(stream['starved'] for stream in self.status):
+            return False
+
+        demand = sum(stream['bitrate'] for stream in self.status) + \
+            sum(reserved_bitrate for reserved_bitrate, _ in self.reservations.values())
+        return demand + bitrate <= self.capacity * (1.0 - min_headroom)
+
+    def admit(self, infohash, bitrate, min_headroom=0.0, timeout=0):
+        """
+        Returns a Deferred firing True when the stream is admitted and False if there was no room
+        within timeout seconds. An admitted stream reserves bitrate until it is measured.
+        """
+        waiter = {'infohash': infohash, 'bitrate': bitrate, 'min_headroom': min_headroom,
+                  'deferred': defer.Deferred(), 'timeout': None}
+        self.admission_queue.append(waiter)
+        self.process_admission_queue()
+
+        if waiter in self.admission_queue:
+            if timeout:
+                waiter['timeout'] = reactor.callLater(timeout, self.reject_waiter, waiter)
+            else:
+                self.reject_waiter(waiter)
+
+        return waiter['deferred']
+
+    def process_admission_queue(self):
+        while self.admission_queue:
+            waiter = self.admission_queue[0]
+            if not self.can_admit(waiter['bitrate'], waiter['min_headroom']):
+                break
+
+            self.admission_queue.pop(0)
+            if waiter['timeout'] is not None and waiter['timeout'].active():
+                waiter['timeout'].cancel()
+            self.reservations[waiter['infohash']] = (waiter['bitrate'], time.time() + RESERVATION_TIMEOUT)
+            waiter['deferred'].callback(True)
+
+    def reject_waiter(self, waiter):
+        if waiter not in self.admission_queue:
+            return
+
+        self.admission_queue.remove(waiter)
+        if waiter['timeout'] is not None and waiter['timeout'].active():
+            waiter['timeout'].cancel()
+        waiter['deferred'].callback(False)
+
+    def get_status(self):
+        return {
+            'capacity': int(self.capacity),
+            'streams': self.status,
+            'starved': [stream['infohash'] for stream in self.status if stream['starved']],
+            'reserved': dict((infohash, bitrate) for infohash, (bitrate, _) in self.reservations.items()),
+            'queued': len(self.admission_queue),
+        }
@@ -0,0 +1,73 @@
+import hashlib
+import hmac
+import time
+
+SIGNATURE_ARGUMENT = 'signature'
+EXPIRES_ARGUMENT = 'expires'
+UNBOUND_ARGUMENT = 'unbound'
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class UrlSigner(object):
+    """
+    Signs and verifies stream URLs with a HMAC so they can be handed to
+    players that are unable to do any kind of authentication.
+
+    The signature covers the serve token, the expiration time and
+    optionally the IP of the client the URL was created for. URLs created without
+    a client IP, e.g. over RPC, are marked as unbound as they can not be bound to one.
+    """
+    def __init__(self, secret, lifetime, bind_ip=False):
+        self.secret = to_bytes(secret)
+        self.lifetime = lifetime
+        self.bind_ip = bind_ip
+
+    def create_signature(self, token, expires, client_ip=None, unbound=False):
+        parts = [to_bytes(token), to_bytes(str(expires)), to_bytes(client_ip or '')]
+        if unbound:
+            parts.append(to_bytes(UNBOUND_ARGUMENT))
+        message = b':'.join(parts)
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def sign(self, token, client_ip=None):
+        """
+        Returns the query arguments that must be appended to the URL serving token.
+        """
+        expires = int(time.time()) + self.lifetime
+        args = [(EXPIRES_ARGUMENT, str(expires))]
+        if not self.bind_ip:
+            client_ip = None
+        elif client_ip is None:
+            args.append((UNBOUND_ARGUMENT, '1'))
+
+        args.append((SIGNATURE_ARGUMENT, self.create_signature(token, expires, client_ip, bool(self.bind_ip and client_ip is None))))
+        return args
+
+    def verify(self, token, args, client_ip=None):
+        """
+        Verify the signature found in args, a twisted request.args-like dict.
+        """
+        expires = args.get(to_bytes(EXPIRES_ARGUMENT))
+        signature = args.get(to_bytes(SIGNATURE_ARGUMENT))
+        if not expires or not signature:
+            return False
+
+        try:
+            expires = int(expires[0])
+        except ValueError:
+            return False
+
+        if expires < time.time():
+            return False
+
+        unbound = bool(self.bind_ip and args.get(to_bytes(UNBOUND_ARGUMENT)))
+        if not self.bind_ip or unbound:
+            client_ip = None
+
+        expected_signature = to_bytes(self.create_signature(token, expires, client_ip, unbound))
+        return hmac.compare_digest(expected_signature, to_bytes(signature[0]))
@@ -0,0 +1,63 @@
+import time
+
+from copy import copy
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key into one call.
+
+    Callers arriving while a call is in flight get a Deferred firing with
+    (a copy of) the result of the first call. Successful results can be kept
+    for memo_time seconds so bursts of calls collapse into one.
+    """
+    def __init__(self, memo_time=0, should_memo=None):
+        self.memo_time = memo_time
+        self.should_memo = should_memo
+        self.in_flight = {}
+        self.memo = {}
+
+    def cleanup_memo(self):
+        now = time.time()
+        for key in [key for key, (expires, _) in self.memo.items() if expires < now]:
+            del self.memo[key]
+
+    def forget(self, key=None):
+        if key is None:
+            self.memo.clear()
+        else:
+            self.memo.pop(key, None)
+
+    def run(self, key, f, *args, **kwargs):
+        self.cleanup_memo()
+        if key in self.memo:
+            return defer.succeed(copy(self.memo[key][1]))
+
+        if key in self.in_flight:
+            d = defer.Deferred()
+            self.in_flight[key].append(d)
+            return d
+
+        waiters = self.in_flight[key] = []
+
+        def done(result):
+            del self.in_flight[key]
+
+            if isinstance(result, Failure):
+                for d in waiters:
+                    d.errback(result)
+            else:
+                if self.memo_time and (self.should_memo is None or self.should_memo(result)):
+                    self.memo[key] = (time.time() + self.memo_time, copy(result))
+
+                for d in waiters:
+                    d.callback(copy(result))
+
+            return result
+
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(done)
+        return d
@@ -0,0 +1,114 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CRITICAL_PIECE_COUNT = 2
+
+
+class StallController(object):
+    """
+    Tunes a torrent while one of its readers has waited for data longer than a threshold.
+
+    More connections are allowed so more peers can send the missing pieces and upload slots are
+    cut to leave the bandwidth to the download. The deadlines of the pieces the stalled readers wait for
+    are set again every check, libtorrent then requests blocks held by slow peers from other peers too.
+    Piece priorities are left to the prioritization of the torrent, it already raises the pieces readers wait for.
+    The torrent options are applied again when the stall clears.
+    """
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.stalled_since = None
+        self.stalls = 0
+        self.stalled_time = 0
+        self.reissued_deadlines = 0
+
+    def get_stalled_pieces(self, threshold):
+        pieces = set()
+        for reader in list(self.torrent.readers.keys()):
+            if reader.get_waiting_time() <= threshold:
+                continue
+
+            try:
+                piece = reader.current_piece[0]
+            except TypeError:  # reader has not seeked yet
+                continue
+            pieces.update(range(piece, piece + CRITICAL_PIECE_COUNT))
+        return pieces
+
+    def update(self, threshold, max_connections, upload_slots):
+        stalled_pieces = self.get_stalled_pieces(threshold)
+        if stalled_pieces:
+            if self.stalled_since is None:
+                self.start_boost(stalled_pieces, max_connections, upload_slots)
+            self.reissue_deadlines(stalled_pieces)
+        elif self.stalled_since is not None:
+            self.stop_boost()
+
+    def get_metrics(self):
+        status = self.torrent.get_status(['download_payload_rate', 'num_peers'])
+        return status['download_payload_rate'], status['num_peers']
+
+    def start_boost(self, stalled_pieces, max_connections, upload_slots):
+        self.stalled_since = time.time()
+        self.stalls += 1
+
+        options = self.torrent.torrent.options
+        handle = self.torrent.torrent.handle
+        if options['max_connections'] >= 0:
+            handle.set_max_connections(max(max_connections, options['max_connections']))
+        if options['max_upload_slots'] < 0 or options['max_upload_slots'] > upload_slots:
+            handle.set_max_uploads(upload_slots)
+
+        download_rate, peers = self.get_metrics()
+        logger.info('Stream of %s stalled at pieces %s, download rate %s bytes/s from %s peers, '
+                    'max connections %s -> %s, upload slots %s -> %s' % (
+                        self.torrent.infohash, sorted(stalled_pieces), download_rate, peers,
+                        options['max_connections'], handle.max_connections(),
+                        options['max_upload_slots'], handle.max_uploads()))
+
+    def reissue_deadlines(self, stalled_pieces):
+        pieces = self.torrent.get_status(['pieces'])['pieces']
+        handle = self.torrent.torrent.handle
+        for piece in stalled_pieces:
+            if piece >= len(pieces) or pieces[piece]:
+                continue
+
+            handle.set_piece_deadline(piece, 0)
+            self.reissued_deadlines += 1
+
+    def stop_boost(self):
+        """
+        Applies the torrent options again, also when they were changed during the stall.
+        """
+        stalled_time = time.time() - self.stalled_since
+        self.stalled_since = None
+        self.stalled_time += stalled_time
+
+        options = self.torrent.torrent.options
+        handle = self.torrent.torrent.handle
+        try:
+            handle.set_max_connections(options['max_connections'])
+            handle.set_max_uploads(options['max_upload_slots'])
+        except RuntimeError:
+            logger.warning('Failed to restore the settings of %s' % (self.torrent.infohash, ))
+            return
+
+        download_rate, peers = self.get_metrics()
+        logger.info('Stall of %s cleared after %.1f seconds, download rate %s bytes/s from %s peers, '
+                    'restored max connections %s and upload slots %s' % (
+                        self.torrent.infohash, stalled_time, download_rate, peers,
+                        options['max_connections'], options['max_upload_slots']))
+
+    def get_status(self):
+        stalled_time = self.stalled_time
+        if self.stalled_since is not None:
+            stalled_time += time.time() - self.stalled_since
+
+        return {
+            'infohash': self.torrent.infohash,
+            'stalled': self.stalled_since is not None,
+            'stalls': self.stalls,
+            'stalled_time': int(stalled_time),
+            'reissued_deadlines': self.reissued_deadlines,
+        }
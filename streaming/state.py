@@ -0,0 +1,29 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_state(path):
+    """
+    Load a saved state file, returns an empty state if it is missing or broken.
+    """
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logger.warning('Failed to load stream state from %s, starting cold' % (path, ))
+        return {}
+
+
+def save_state(path, state):
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        logger.exception('Failed to save stream state to %s' % (path, ))
@@ -12,6 +12,7 @@ logger = logging.getLogger(__name__)
 
 PIECE_REQUEST_HISTORY_TIME = 10
 MAX_PIECE_REQUEST_COUNT = 20
+MAX_PIECE_WAIT_TIME = 1000
 
 class DelugeTorrentInput(InputBase):
     plugin_name = 'torrent_file'
@@ -20,19 +21,24 @@ class DelugeTorrentInput(InputBase):
     current_piece_data = None
     can_read_to = None
     last_available_piece = None
+    waiting_since = None
+    estimated_bitrate = 0
     _pos = None
     _closed = False
+    close_on_finish = True
 
     def __init__(self, item, torrent_handler, infohash, offset, path):
         self.item = item
         self.torrent_handler = torrent_handler
         self.torrent = torrent_handler.get_torrent(infohash)
+        self.buffer_pool = torrent_handler.buffer_pool
         self.infohash = infohash
         self.offset = offset
         self.path = path
         self.piece_buffer = {}
         self.requested_pieces = {}
         self.piece_consumption_time = []
+        self.cancelled = threading.Event()
         self.size, self.filename, self.content_type = self.get_info()
 
     def get_info(self):
@@ -42,9 +48,15 @@ class DelugeTorrentInput(InputBase):
 
         return self.item['size'], os.path.basename(self.path), content_type
 
+    def get_read_deadline(self):
+        stall_timeout = self.torrent_handler.read_stall_timeout
+        if not stall_timeout:
+            return None
+        return time.time() + stall_timeout
+
     def ensure_exists(self):
         if not os.path.exists(self.path):
-            self.torrent.can_read(self.offset)
+            self.torrent.can_read(self.offset, self.cancelled, self.get_read_deadline())
 
     def tell(self):
         return self._pos
@@ -66,6 +78,16 @@ class DelugeTorrentInput(InputBase):
             if data:
                 return data
 
+        self.waiting_since = time.time()
+        try:
+            return self._read_next_piece(num)
+        finally:
+            self.waiting_since = None
+
+    def _read_next_piece(self, num):
+        if self._closed:
+            return b''
+
         self.ensure_exists()
 
         if self._pos is None:
@@ -74,7 +96,10 @@ class DelugeTorrentInput(InputBase):
         logger.debug('Trying to read %s from %i torrentfile_id %r' % (self.path, self.tell(), id(self)))
         tell = self.tell()
         if self.can_read_to is None or self.can_read_to <= tell:
-            can_read_result = self.torrent.can_read(self.offset + tell)
+            can_read_result = self.torrent.can_read(self.offset + tell, self.cancelled, self.get_read_deadline())
+            if can_read_result is None:
+                logger.debug('Stopped waiting for %s at %i torrentfile_id %r' % (self.path, tell, id(self)))
+                return b''
             self.last_available_piece = can_read_result[1]
             self.can_read_to = can_read_result[0] + tell
 
@@ -86,6 +111,9 @@ class DelugeTorrentInput(InputBase):
 
         max_piece_count = (self.last_available_piece - current_piece) + 1
         pieces_to_request = min(min(max(2, len(self.piece_consumption_time)), max_piece_count), MAX_PIECE_REQUEST_COUNT)
+        reader_budget = self.buffer_pool.get_reader_budget(self.torrent.piece_length)
+        if reader_budget is not None:
+            pieces_to_request = min(pieces_to_request, reader_budget)
 
         logger.debug('New piece request status pieces_to_request: %s piece_consumption_time: %s max_piece_count: %s' % (pieces_to_request, len(self.piece_consumption_time), max_piece_count, ))
         logger.debug('Requested pieces: %r' % (self.requested_pieces.items()))
@@ -97,28 +125,65 @@ class DelugeTorrentInput(InputBase):
 
             logger.debug('Requesting piece %s' % (piece, ))
             self.requested_pieces[piece] = threading.Event()
-            self.torrent.request_piece(piece)
+            self.torrent.request_piece(piece, self)
 
-        for _ in range(1000):
-            if self.requested_pieces[current_piece].wait(1):
-                break
+        if self._closed:  # closed while the pieces were requested
+            return b''
+
+        piece_event = self.requested_pieces.get(current_piece)
+        if piece_event is None:
+            logger.debug('Piece %s was evicted before it was waited for, requesting it again' % (current_piece, ))
+            return self._read_next_piece(num)
+
+        deadline = time.time() + (self.torrent_handler.read_stall_timeout or MAX_PIECE_WAIT_TIME)
+        while not piece_event.wait(1):
             if self._closed:
                 return b''
-        else:
+            if self.requested_pieces.get(current_piece) is not piece_event:
+                logger.debug('Piece %s was evicted while it was waited for, requesting it again' % (current_piece, ))
+                return self._read_next_piece(num)
+            if time.time() > deadline:
+                logger.warning('Read of piece %s from %s stalled, giving up' % (current_piece, self.path))
+                return b''
+
+        if self._closed:
             return b''
 
-        for delete_piece in [p for p in self.piece_buffer.keys() if p < current_piece]:
-            del self.piece_buffer[delete_piece]
+        for delete_piece in [p for p in list(self.piece_buffer.keys()) if p < current_piece]:
+            self.piece_buffer.pop(delete_piece, None)
+            self.buffer_pool.remove(self, delete_piece)
+
+        for delete_piece in [p for p in list(self.requested_pieces.keys()) if p < current_piece]:
+            self.requested_pieces.pop(delete_piece, None)
 
-        for delete_piece in [p for p in self.requested_pieces.keys() if p < current_piece]:
-            del self.requested_pieces[delete_piece]
+        current_piece_data = self.piece_buffer.get(current_piece)
+        if current_piece_data is None:
+            logger.debug('Piece %s was evicted before it was read, requesting it again' % (current_piece, ))
+            self.requested_pieces.pop(current_piece, None)
+            return self._read_next_piece(num)
 
-        self.current_piece_data = self.piece_buffer[current_piece]
+        self.current_piece_data = current_piece_data
         self.current_piece_data.seek(rest)
         self.piece_consumption_time.append(time.time())
         logger.debug('Returning %s bytes' % (num, ))
         return self._read(num)
 
+    def get_bitrate(self):
+        """
+        Estimated bytes per second consumed by this reader, the last estimate is kept while stalled.
+        """
+        now = time.time()
+        consumed = [t for t in self.piece_consumption_time if t > now - PIECE_REQUEST_HISTORY_TIME]
+        if len(consumed) >= 2:
+            self.estimated_bitrate = (len(consumed) * self.torrent.piece_length) // PIECE_REQUEST_HISTORY_TIME
+        return self.estimated_bitrate
+
+    def get_waiting_time(self):
+        waiting_since = self.waiting_since
+        if waiting_since is None:
+            return 0
+        return time.time() - waiting_since
+
     @property
     def current_piece(self):
         from_byte = self.offset + self.tell()
@@ -133,7 +198,25 @@ class DelugeTorrentInput(InputBase):
         logger.debug("Setting data for piece %s" % (piece, ))
         self.piece_buffer[piece] = BytesIO(data)
         self.requested_pieces[piece].set()
+        self.buffer_pool.add(self, piece, len(data))
+
+    def evict_piece(self, piece):
+        """
+        Drops a buffered piece to free memory, it is requested again if the reader gets to it.
+        """
+        logger.debug('Evicting buffered piece %s' % (piece, ))
+        self.piece_buffer.pop(piece, None)
+        self.requested_pieces.pop(piece, None)
 
     def close(self):
-        self.torrent.remove_reader(self)
+        """
+        Can be called from any thread, reads waiting for data return right away.
+        """
         self._closed = True
+        self.cancelled.set()
+        for piece_event in list(self.requested_pieces.values()):
+            piece_event.set()
+
+        self.torrent.remove_reader(self)
+        self.piece_buffer = {}
+        self.buffer_pool.remove_reader(self)
@@ -0,0 +1,179 @@
+"""
+Worker processes serving completely downloaded files.
+
+The daemon binds the worker socket and passes it to every worker, the kernel
+spreads the incoming connections between them. Workers only serve urls created
+with create_completed_url, everything still downloading is served by the daemon.
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+
+from twisted.internet import defer, protocol, reactor, task
+
+logger = logging.getLogger(__name__)
+
+WORKER_FD = 3
+WORKER_RESTART_DELAY = 5
+WORKER_KILL_TIMEOUT = 10
+PARENT_CHECK_INTERVAL = 5
+SECRET_ENVIRONMENT_VARIABLE = 'STREAMING_WORKER_SECRET'
+
+
+def can_use_workers():
+    from twisted.internet.interfaces import IReactorSocket
+    return os.name == 'posix' and IReactorSocket.providedBy(reactor)
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def errReceived(self, data):
+        logger.debug('Worker %s: %s' % (self.transport.pid, data.decode('utf-8', 'replace').rstrip()))
+
+    def processEnded(self, reason):
+        self.pool.worker_ended(self, reason)
+
+
+class WorkerPool(object):
+    def __init__(self, worker_count, interface, port, secret, bind_ip=False, trust_forwarded_for=False):
+        self.worker_count = worker_count
+        self.interface = interface
+        self.port = port
+        self.secret = secret
+        self.bind_ip = bind_ip
+        self.trust_forwarded_for = trust_forwarded_for
+
+        self.socket = None
+        self.workers = set()
+        self.running = False
+        self.stop_waiters = []
+
+    def start(self):
+        if ':' in self.interface:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.interface, self.port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.family = family
+
+        self.running = True
+        for _ in range(self.worker_count):
+            self.spawn_worker()
+
+        logger.info('Started %s workers on %s:%s' % (self.worker_count, self.interface, self.port))
+
+    def spawn_worker(self):
+        if not self.running:
+            return
+
+        plugin_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([plugin_path] + [p for p in [env.get('PYTHONPATH')] if p])
+        env[SECRET_ENVIRONMENT_VARIABLE] = self.secret
+
+        args = [sys.executable, '-m', 'streaming.worker', '--fd', str(WORKER_FD),
+                '--family', self.family == socket.AF_INET6 and 'ipv6' or 'ipv4']
+        if self.bind_ip:
+            args.append('--bind-ip')
+        if self.trust_forwarded_for:
+            args.append('--trust-forwarded-for')
+
+        worker = WorkerProcessProtocol(self)
+        reactor.spawnProcess(worker, sys.executable, args, env=env,
+                             childFDs={0: 'w', 1: 'r', 2: 'r', WORKER_FD: self.socket.fileno()})
+        self.workers.add(worker)
+
+    def worker_ended(self, worker, reason):
+        self.workers.discard(worker)
+        if self.running:
+            logger.warning('Worker ended (%s), starting a new one in %s seconds' % (reason.getErrorMessage(), WORKER_RESTART_DELAY))
+            reactor.callLater(WORKER_RESTART_DELAY, self.spawn_worker)
+        elif not self.workers:
+            stop_waiters, self.stop_waiters = self.stop_waiters, []
+            for d in stop_waiters:
+                d.callback(None)
+
+    def signal_workers(self, signal):
+        for worker in list(self.workers):
+            try:
+                worker.transport.signalProcess(signal)
+            except Exception:
+                pass
+
+    def stop(self):
+        """
+        Returns a Deferred firing when every worker has ended, the workers keep the port
+        bound until then. Workers still running after WORKER_KILL_TIMEOUT are killed.
+        """
+        self.running = False
+        self.signal_workers('TERM')
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        if not self.workers:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self.stop_waiters.append(d)
+        kill_call = reactor.callLater(WORKER_KILL_TIMEOUT, self.signal_workers, 'KILL')
+
+        def cancel_kill(result):
+            if kill_call.active():
+                kill_call.cancel()
+            return result
+
+        d.addBoth(cancel_kill)
+        return d
+
+
+def run_worker(args):
+    from twisted.web import server
+    from twisted.web.resource import Resource as TwistedResource
+
+    from streaming.completed import CompletedFileResource
+    from streaming.signing import UrlSigner
+
+    signer = UrlSigner(os.environ.pop(SECRET_ENVIRONMENT_VARIABLE), 0, args.bind_ip)
+
+    resource = TwistedResource()
+    resource.putChild(b'completed', CompletedFileResource(signer, trust_forwarded_for=args.trust_forwarded_for))
+    base_resource = TwistedResource()
+    base_resource.putChild(b'streaming', resource)
+
+    if args.family == 'ipv6':
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    reactor.adoptStreamPort(args.fd, family, server.Site(base_resource))
+    os.close(args.fd)
+
+    parent_pid = os.getppid()
+
+    def check_parent():
+        if os.getppid() != parent_pid:
+            reactor.stop()
+
+    task.LoopingCall(check_parent).start(PARENT_CHECK_INTERVAL)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming worker process.')
+    parser.add_argument('--fd', type=int, default=WORKER_FD, help='Listening socket passed from the daemon')
+    parser.add_argument('--family', choices=['ipv4', 'ipv6'], default='ipv4')
+    parser.add_argument('--bind-ip', action='store_true', help='Signatures are bound to the client ip')
+    parser.add_argument('--trust-forwarded-for', action='store_true', help='Use X-Forwarded-For as client ip')
+
+    logging.basicConfig(level=logging.WARNING)
+    run_worker(parser.parse_args())
@@ -0,0 +1,52 @@
+import random
+import time
+import unittest
+
+from streaming.bitfield import Bitfield
+
+
+class BitfieldTestCase(unittest.TestCase):
+    def test_lookups(self):
+        bools = [True, False, True, True, False]
+        bitfield = Bitfield.from_bools(bools)
+
+        self.assertEqual(len(bitfield), 5)
+        self.assertEqual([bitfield[i] for i in range(5)], bools)
+        self.assertFalse(bitfield[-1])
+        self.assertRaises(IndexError, lambda: bitfield[5])
+        self.assertEqual(bitfield.first_unset(), 1)
+        self.assertEqual(bitfield.first_unset(2), 4)
+        self.assertEqual(bitfield.first_unset(2, 4), None)
+        self.assertEqual(bitfield.first_set(1), 2)
+        self.assertEqual(list(bitfield.iter_unset()), [1, 4])
+        self.assertEqual(bitfield.count_set(), 3)
+        self.assertEqual(bitfield.count_set(1, 3), 1)
+        self.assertTrue(bitfield.all_set(2, 4))
+        self.assertTrue(bitfield.all_set(3, 3))
+
+    def test_empty(self):
+        bitfield = Bitfield.from_bools([])
+        self.assertEqual(len(bitfield), 0)
+        self.assertEqual(bitfield.first_unset(), None)
+        self.assertEqual(list(bitfield.iter_unset()), [])
+        self.assertEqual(bitfield.count_set(), 0)
+
+    def test_large_torrent(self):
+        rng = random.Random(1)
+        bools = [rng.random() < 0.3 for _ in range(40000)]
+        bitfield = Bitfield.from_bools(bools)
+
+        start = time.time()
+        unset = list(bitfield.iter_unset())
+        values = [bitfield[i] for i in range(len(bitfield))]
+        elapsed = time.time() - start
+
+        self.assertEqual(unset, [i for i, b in enumerate(bools) if not b])
+        self.assertEqual(values, bools)
+        self.assertEqual(bitfield.count_set(), sum(bools))
+        self.assertEqual(bitfield.first_unset(20000), bools.index(False, 20000))
+        self.assertLess(elapsed, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import shutil
+import tempfile
+
+from deluge.bencode import bencode
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+
+from streaming.fetcher import FetchError, TorrentFetcher
+
+URL = 'http://example.com/test.torrent'
+TORRENT = bencode({b'announce': b'http://example.com/announce',
+                   b'info': {b'name': b'test', b'length': 1, b'piece length': 16384, b'pieces': b'0' * 20}})
+
+
+class FakeResponse(object):
+    phrase = b'OK'
+
+    def __init__(self, code, body=b'', headers=None):
+        self.code = code
+        self.body = body
+        self.length = len(body)
+        self.headers = Headers(headers or {})
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def request(self, method, uri, headers=None):
+        self.requests.append(headers)
+        response = self.responses.pop(0)
+        if response is None:
+            return defer.Deferred()
+        return defer.succeed(response)
+
+
+class TorrentFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.fetcher = TorrentFetcher(self.cache_path, max_age=3600, timeout=0.1)
+        self.agent = self.fetcher.agent = FakeAgent()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    @defer.inlineCallbacks
+    def test_fetch_is_cached(self):
+        self.agent.responses.append(FakeResponse(200, TORRENT))
+
+        body = yield self.fetcher.fetch(URL)
+        self.assertEqual(body, TORRENT)
+
+        body = yield self.fetcher.fetch(URL)
+        self.assertEqual(body, TORRENT)
+        self.assertEqual(len(self.agent.requests), 1)
+
+    @defer.inlineCallbacks
+    def test_etag_revalidation(self):
+        self.agent.responses.append(FakeResponse(200, TORRENT, {b'ETag': [b'"v1"']}))
+        yield self.fetcher.fetch(URL)
+
+        self.fetcher.max_age = 0
+        self.agent.responses.append(FakeResponse(304))
+        body = yield self.fetcher.fetch(URL)
+
+        self.assertEqual(body, TORRENT)
+        self.assertEqual(self.agent.requests[1].getRawHeaders(b'If-None-Match'), [b'"v1"'])
+
+    @defer.inlineCallbacks
+    def test_invalid_body_is_not_cached(self):
+        self.agent.responses.append(FakeResponse(200, b'<html>login</html>'))
+        yield self.assertFailure(self.fetcher.fetch(URL), FetchError)
+        self.assertEqual(self.fetcher.index, {})
+
+    @defer.inlineCallbacks
+    def test_invalid_body_falls_back_to_cache(self):
+        self.agent.responses.append(FakeResponse(200, TORRENT))
+        yield self.fetcher.fetch(URL)
+
+        self.fetcher.max_age = 0
+        self.agent.responses.append(FakeResponse(200, b'<html>login</html>'))
+        body = yield self.fetcher.fetch(URL)
+        self.assertEqual(body, TORRENT)
+        self.assertEqual(self.fetcher.read_body(URL), TORRENT)
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.agent.responses.append(None)
+        failure = yield self.assertFailure(self.fetcher.fetch(URL), FetchError)
+        self.assertIn('timeout', str(failure))
@@ -0,0 +1,74 @@
+import unittest
+
+from twisted.web.resource import ForbiddenResource, Resource as TwistedResource
+from twisted.web.test.requesthelper import DummyRequest
+
+from thomas.outputs.http import FilelikeObjectResource
+from thomas.txiobuffer import TwistedIOBuffer
+
+from streaming.resource import SignedResource, close_on_finish, get_client_ip
+from streaming.signing import UrlSigner
+
+
+def create_request(forwarded_for=None, args=None):
+    request = DummyRequest([])
+    if forwarded_for is not None:
+        request.requestHeaders.setRawHeaders(b'X-Forwarded-For', [forwarded_for])
+    if args:
+        request.args = dict((key.encode('utf-8'), [value.encode('utf-8')]) for key, value in args)
+    return request
+
+
+class GetClientIPTestCase(unittest.TestCase):
+    def test_forwarded_for_not_trusted(self):
+        request = create_request(b'6.6.6.6')
+        self.assertNotEqual(get_client_ip(request), '6.6.6.6')
+
+    def test_single_hop(self):
+        self.assertEqual(get_client_ip(create_request(b'10.0.0.5'), True), '10.0.0.5')
+
+    def test_forged_multi_hop(self):
+        request = create_request(b'6.6.6.6, 7.7.7.7,10.0.0.5')
+        self.assertEqual(get_client_ip(request, True), '10.0.0.5')
+
+
+class ClosableFile(object):
+    close_on_finish = True
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class CloseOnFinishTestCase(unittest.TestCase):
+    def test_thomas_file_resource_is_closed(self):
+        file_object = ClosableFile()
+        resource = FilelikeObjectResource(TwistedIOBuffer(file_object), 10)
+        request = create_request()
+
+        close_on_finish(request, resource)
+        self.assertFalse(file_object.closed)
+        request.finish()
+        self.assertTrue(file_object.closed)
+
+
+class SignedResourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.signer = UrlSigner('secret', 60, bind_ip=True)
+        self.resource = SignedResource(TwistedResource(), self.signer, trust_forwarded_for=True)
+
+    def test_forged_forwarded_for_is_rejected(self):
+        args = self.signer.sign('token', '6.6.6.6')
+        request = create_request(b'6.6.6.6, 10.0.0.5', args)
+        child = self.resource.getChildWithDefault(b'token', request)
+        self.assertIsInstance(child, ForbiddenResource)
+
+    def test_proxy_forwarded_for_is_accepted(self):
+        args = self.signer.sign('token', '10.0.0.5')
+        request = create_request(b'6.6.6.6, 10.0.0.5', args)
+        child = self.resource.getChildWithDefault(b'token', request)
+        self.assertNotIsInstance(child, ForbiddenResource)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from streaming.scheduler import StreamScheduler
+
+
+class FakeTorrentHandler(object):
+    def __init__(self):
+        self.torrents = {}
+
+
+class StreamSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = StreamScheduler(FakeTorrentHandler())
+        self.download_rate = 0
+        self.scheduler.get_session_download_rate = lambda: self.download_rate
+
+    def admit(self, infohash, bitrate):
+        results = []
+        self.scheduler.admit(infohash, bitrate).addCallback(results.append)
+        return results[0]
+
+    def test_admit_after_idle(self):
+        self.download_rate = 10 * 1024 * 1024
+        self.scheduler.tick()
+        self.download_rate = 0
+        for _ in range(1000):
+            self.scheduler.tick()
+
+        self.assertTrue(0 < self.scheduler.capacity < 1024)
+        self.assertTrue(self.admit('a' * 40, 1024 * 1024))
+        self.assertFalse(self.admit('b' * 40, 1024 * 1024))
+
+    def test_admit_within_capacity(self):
+        self.download_rate = 10 * 1024 * 1024
+        self.scheduler.tick()
+
+        self.assertTrue(self.admit('a' * 40, 4 * 1024 * 1024))
+        self.assertTrue(self.admit('b' * 40, 4 * 1024 * 1024))
+        self.assertFalse(self.admit('c' * 40, 4 * 1024 * 1024))
+        self.assertEqual(sorted(self.scheduler.get_status()['reserved']), ['a' * 40, 'b' * 40])
+
+
+if __name__ == '__main__':
+    unittest.main()